@@ -0,0 +1,217 @@
+# bench/bench_funnel.py
+
+"""
+Офлайн-бенчмарк воронки без Telegram и Postgres.
+
+Запуск из корня репозитория:
+    python -m bench.bench_funnel --users 1000 10000 100000 1000000
+"""
+
+import os
+
+# Настройки читаются из окружения при импорте, реальные значения не нужны
+for name, value in {
+    "DB_PASS": "bench",
+    "DB_LOGIN": "bench",
+    "DB_PORT": "5432",
+    "API_ID": "0",
+    "API_HASH": "bench",
+}.items():
+    os.environ.setdefault(name, value)
+
+import argparse
+import asyncio
+import random
+import time
+
+from bench.fakes import FakeClient, fake_message
+from bench.memory_db import MemoryDatabase
+from core.client.client import TelegramClient
+from core.funnel.funnel import MessageFunnel
+from core.settings.settings import settings
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+async def run_inbound(funnel: MessageFunnel, client: FakeClient, args) -> dict:
+    """
+    Прогоняет входящие сообщения через process_message.
+    """
+    rng = random.Random(args.seed)
+    if args.burst:
+        # Пользователь присылает все сообщения подряд, как серию реплик
+        order = (
+            (user_id, n)
+            for user_id in range(1, args.users + 1)
+            for n in range(args.messages_per_user)
+        )
+    else:
+        order = (
+            (user_id, n)
+            for n in range(args.messages_per_user)
+            for user_id in range(1, args.users + 1)
+        )
+    messages = (
+        fake_message(
+            user_id,
+            "прекрасно" if rng.random() < args.trigger_rate else f"сообщение {n}",
+        )
+        for user_id, n in order
+    )
+    latencies: list[float] = []
+    # Задержка считается от первого сообщения пачки до конца ее обработки,
+    # иначе при объединении замерялось бы только добавление в окно
+    opened_at: dict[int, float] = {}
+    process_user_messages = funnel.process_user_messages
+
+    async def timed(user_id: int, batch: list):
+        await process_user_messages(user_id, batch)
+        started_at = opened_at.pop(user_id, None)
+        if started_at is not None:
+            latencies.append(time.perf_counter() - started_at)
+
+    funnel.process_user_messages = funnel.inbound.handler = timed
+
+    async def worker():
+        for message in messages:
+            client.remember(message)
+            opened_at.setdefault(message.from_user.id, time.perf_counter())
+            await funnel.process_message(message)
+
+    started_at = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    await funnel.inbound.flush()
+    elapsed = time.perf_counter() - started_at
+    return {
+        "inbound_per_sec": args.users * args.messages_per_user / elapsed if elapsed else 0.0,
+        "handler_p50_ms": percentile(latencies, 0.50) * 1000,
+        "handler_p99_ms": percentile(latencies, 0.99) * 1000,
+    }
+
+
+async def run_sends(funnel: MessageFunnel, stop: asyncio.Event, args):
+    """
+    Отправляет запланированные сообщения, пока не будет установлен stop.
+    """
+    if args.mode == "scheduler":
+        scheduler = asyncio.create_task(funnel.scheduler.run())
+        await stop.wait()
+        scheduler.cancel()
+        try:
+            await scheduler
+        except asyncio.CancelledError:
+            pass
+    else:
+        while not stop.is_set():
+            if not await funnel.send_scheduled_messages():
+                await asyncio.sleep(0.01)
+
+
+async def run(args, users: int) -> dict:
+    args.users = users
+    db = MemoryDatabase()
+    await db.connect()
+    client = FakeClient(
+        latency=args.latency,
+        jitter=args.jitter,
+        flood_rate=args.flood_rate,
+        flood_wait=args.flood_wait,
+        seed=args.seed,
+    )
+    funnel = MessageFunnel(db, TelegramClient(client))
+
+    # Отправка идет параллельно с входящими, как в рабочем процессе
+    stop = asyncio.Event()
+    started_at = time.perf_counter()
+    sends = asyncio.create_task(run_sends(funnel, stop, args))
+    result = {"users": users}
+    result.update(await run_inbound(funnel, client, args))
+    # Статусы пользователей попадают в хранилище после сброса отложенной записи
+    await db.flush()
+
+    steps = len(settings.funnel_steps())
+    alive = sum(1 for user in db.users_by_id.values() if user.status == "alive")
+    expected = alive * steps
+    deadline = started_at + args.timeout
+    while len(db.sent) < expected and time.perf_counter() < deadline:
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - started_at
+    stop.set()
+    await sends
+    await db.close()
+
+    result.update(
+        {
+            "sent": len(db.sent),
+            "expected": expected,
+            "sends_per_sec": len(db.sent) / elapsed if elapsed else 0.0,
+            "lateness_p50_ms": percentile(db.lateness, 0.50) * 1000,
+            "lateness_p99_ms": percentile(db.lateness, 0.99) * 1000,
+            "flood_waits": client.flood_waits,
+            "db_queries": db.queries,
+        }
+    )
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, nargs="+", default=[1000, 10_000, 100_000])
+    parser.add_argument("--messages-per-user", type=int, default=2)
+    parser.add_argument("--trigger-rate", type=float, default=0.01)
+    parser.add_argument(
+        "--burst", action="store_true", help="сообщения пользователя приходят подряд"
+    )
+    parser.add_argument(
+        "--inbound-window", type=int, default=None, help="окно объединения, мс (0 - без него)"
+    )
+    parser.add_argument("--concurrency", type=int, default=64, help="параллельных обработчиков")
+    parser.add_argument("--mode", choices=("scheduler", "sweep"), default="scheduler")
+    parser.add_argument("--interval", type=float, default=1.0, help="секунд между шагами")
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка Telegram, с")
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="доля FloodWait")
+    parser.add_argument("--flood-wait", type=int, default=1)
+    parser.add_argument("--rate", type=float, default=1e9, help="лимит отправки, сообщ./с")
+    parser.add_argument("--timeout", type=float, default=600.0)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    settings.funnel_intervals = [0] + [args.interval] * (len(settings.funnel_messages) - 1)
+    settings.send_global_rate = settings.send_global_burst = args.rate
+    settings.send_chat_rate = settings.send_chat_burst = args.rate
+    settings.send_rate_min = min(settings.send_rate_min, args.rate)
+    if args.inbound_window is not None:
+        settings.inbound_window = args.inbound_window
+
+    columns = (
+        "users",
+        "inbound_per_sec",
+        "handler_p50_ms",
+        "handler_p99_ms",
+        "sent",
+        "sends_per_sec",
+        "lateness_p50_ms",
+        "lateness_p99_ms",
+        "flood_waits",
+        "db_queries",
+    )
+    print(" ".join(f"{column:>16}" for column in columns))
+    for users in args.users:
+        result = asyncio.run(run(args, users))
+        print(
+            " ".join(
+                f"{result[column]:>16.2f}" if isinstance(result[column], float)
+                else f"{result[column]:>16}"
+                for column in columns
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+# bench/fakes.py
+
+import asyncio
+import random
+from types import SimpleNamespace
+from typing import Optional
+
+from pyrogram.errors import FloodWait
+
+
+def fake_message(user_id: int, text: str, outgoing: bool = False) -> SimpleNamespace:
+    """
+    Создает объект с полями pyrogram Message, которые использует воронка.
+
+    :param user_id: ID пользователя (и чата)
+    :param text: Текст сообщения
+    :param outgoing: Исходящее сообщение
+    """
+    user = SimpleNamespace(id=user_id)
+    return SimpleNamespace(
+        text=text, outgoing=outgoing, from_user=user, chat=SimpleNamespace(id=user_id)
+    )
+
+
+class FakeClient:
+    """Заменяет pyrogram Client: задержка сети, FloodWait и история чатов в памяти"""
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        flood_rate: float = 0.0,
+        flood_wait: int = 1,
+        history_limit: int = 10,
+        seed: Optional[int] = None,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.flood_rate = flood_rate
+        self.flood_wait = flood_wait
+        self.history_limit = history_limit
+        self.random = random.Random(seed)
+        self.history: dict[int, list[SimpleNamespace]] = {}
+        self.sent = 0
+        self.flood_waits = 0
+
+    async def _network(self):
+        delay = self.latency + self.random.uniform(0, self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def remember(self, message: SimpleNamespace):
+        """
+        Добавляет сообщение в историю чата.
+
+        :param message: Сообщение из fake_message
+        """
+        history = self.history.setdefault(message.chat.id, [])
+        history.append(message)
+        del history[: -self.history_limit]
+
+    async def send_message(self, chat_id: int, text: str):
+        await self._network()
+        if self.flood_rate and self.random.random() < self.flood_rate:
+            self.flood_waits += 1
+            raise FloodWait(value=self.flood_wait)
+        self.sent += 1
+        self.remember(fake_message(chat_id, text, outgoing=True))
+
+    async def get_chat_history(self, chat_id: int, limit: int = 0):
+        await self._network()
+        history = self.history.get(chat_id, [])
+        for message in reversed(history[-limit:] if limit else history):
+            yield message
@@ -0,0 +1,178 @@
+# bench/memory_db.py
+
+import heapq
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from core.db.models import StepRow, User, UserRow
+from core.db.storage import Storage
+from core.settings.settings import settings
+
+
+class MemoryDatabase(Storage):
+    """
+    Хранилище в памяти для бенчмарка.
+
+    Реализует только запросы, кэш пользователей и отложенная запись
+    берутся из Storage, как у рабочих хранилищ.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.users_by_id: dict[int, User] = {}
+        self.sessions: dict[int, str] = {}  # user_id -> сессия Telegram пользователя
+        self.due: dict[tuple[int, int], datetime] = {}  # (user_id, step) -> due_at
+        self.sent: dict[tuple[int, int], datetime] = {}
+        # Для каждого пользователя в очереди только его следующий неотправленный шаг
+        self._ready: list[tuple[datetime, int, int]] = []  # (available_at, user_id, step)
+        self._leases: dict[tuple[int, int], tuple[str, datetime]] = {}
+        self.lateness: list[float] = []  # секунды между due_at и отметкой об отправке
+        self.queries = 0
+
+    async def connect(self):
+        self._start_flusher()
+
+    async def _close(self):
+        pass
+
+    async def health_check(self) -> bool:
+        return True
+
+    async def _fetch_user(self, user_id: int) -> Optional[User]:
+        self.queries += 1
+        user = self.users_by_id.get(user_id)
+        return user.model_copy() if user is not None else None
+
+    async def _insert_user(self, user: User, steps: list[int], due_times: list[datetime]) -> bool:
+        self.queries += 1
+        if user.id in self.users_by_id:
+            return False
+        self.users_by_id[user.id] = user.model_copy()
+        self.sessions[user.id] = settings.session_name
+        for step, due_at in zip(steps, due_times):
+            self.due[(user.id, step)] = due_at
+        if due_times:
+            heapq.heappush(self._ready, (due_times[0], user.id, steps[0]))
+        return True
+
+    async def _insert_users(self, user_ids, created_at, steps, due_times) -> int:
+        inserted = 0
+        for user_id in user_ids:
+            user = User(id=user_id, created_at=created_at, status="alive", status_updated_at=created_at)
+            inserted += await self._insert_user(user, steps, due_times)
+        return inserted
+
+    async def _write_updates(self, sent_steps, last_sent, statuses):
+        self.queries += 1
+        for (user_id, step), sent_at in sent_steps.items():
+            self._mark_sent_step(user_id, step, sent_at)
+        for user_id, sent_at in last_sent.items():
+            user = self.users_by_id.get(user_id)
+            if user is not None and (
+                user.last_message_sent_at is None or user.last_message_sent_at < sent_at
+            ):
+                user.last_message_sent_at = sent_at
+        for user_id, (status, updated_at) in statuses.items():
+            user = self.users_by_id.get(user_id)
+            if user is not None:
+                user.status = status
+                user.status_updated_at = updated_at
+
+    def _mark_sent_step(self, user_id: int, step: int, sent_at: datetime):
+        if (user_id, step) in self.sent:
+            return
+        self.sent[(user_id, step)] = sent_at
+        self._leases.pop((user_id, step), None)
+        self.lateness.append((sent_at - self.due[(user_id, step)]).total_seconds())
+        next_due = self.due.get((user_id, step + 1))
+        if next_due is not None:
+            heapq.heappush(self._ready, (next_due, user_id, step + 1))
+
+    async def get_user_msg_times(self, user_id: int) -> dict[int, datetime]:
+        return {step: due_at for (uid, step), due_at in self.due.items() if uid == user_id}
+
+    async def get_new_users(self, page_size: int):
+        for user in list(self.users_by_id.values()):
+            if user.last_message_sent_at is None and user.status == "alive":
+                yield UserRow(*user.model_dump().values())
+
+    async def get_users_for_message(self, interval: timedelta, page_size: int):
+        threshold = datetime.now(timezone.utc) - interval
+        due_users = {
+            user_id
+            for (user_id, step), due_at in self.due.items()
+            if due_at <= threshold and (user_id, step) not in self.sent
+        }
+        for user_id in sorted(due_users):
+            user = self.users_by_id[user_id]
+            if user.status == "alive":
+                yield UserRow(*user.model_dump().values())
+
+    async def get_users_to_send_messages(self, page_size: int):
+        async for row in self.iter_pending_messages(datetime.now(timezone.utc), page_size):
+            yield row
+
+    async def _claim_due_steps(self, owner: str, limit: int, lease_seconds: float):
+        self.queries += 1
+        now = datetime.now(timezone.utc)
+        lease_expires_at = now + timedelta(seconds=lease_seconds)
+
+        # Просроченные аренды возвращаются в очередь
+        for key, (_, expires_at) in list(self._leases.items()):
+            if expires_at < now:
+                del self._leases[key]
+                heapq.heappush(self._ready, (self.due[key], *key))
+
+        claimed = []
+        while self._ready and len(claimed) < limit and self._ready[0][0] <= now:
+            _, user_id, step = heapq.heappop(self._ready)
+            key = (user_id, step)
+            if key in self.sent or key in self._leases:
+                continue
+            if self.users_by_id[user_id].status != "alive":
+                continue
+            if self.sessions[user_id] != settings.session_name:
+                continue
+            self._leases[key] = (owner, lease_expires_at)
+            claimed.append(StepRow(user_id, step, self.due[key]))
+        return claimed
+
+    async def _mark_sent(self, user_id: int, step: int, owner: str, sent_at: datetime) -> bool:
+        self.queries += 1
+        lease = self._leases.get((user_id, step))
+        if lease is None or lease[0] != owner or (user_id, step) in self.sent:
+            return False
+        self._mark_sent_step(user_id, step, sent_at)
+        user = self.users_by_id[user_id]
+        if user.last_message_sent_at is None or user.last_message_sent_at < sent_at:
+            user.last_message_sent_at = sent_at
+        return True
+
+    async def release_step(self, user_id: int, step: int, owner: str, retry_at: datetime):
+        self.queries += 1
+        lease = self._leases.get((user_id, step))
+        if lease is None or lease[0] != owner:
+            return
+        del self._leases[(user_id, step)]
+        heapq.heappush(self._ready, (retry_at, user_id, step))
+
+    async def archive_users(self, before: datetime, limit: int) -> int:
+        # Архивация в бенчмарке не измеряется
+        return 0
+
+    async def purge_archive(self, before: datetime):
+        pass
+
+    async def iter_pending_messages(self, until: datetime, page_size: int):
+        self.queries += 1
+        pending = [
+            StepRow(user_id, step, due_at)
+            for (user_id, step), due_at in self.due.items()
+            if due_at <= until
+            and (user_id, step) not in self.sent
+            and ((user_id, step - 1) not in self.due or (user_id, step - 1) in self.sent)
+            and self.users_by_id[user_id].status == "alive"
+            and self.sessions[user_id] == settings.session_name
+        ]
+        for row in sorted(pending, key=lambda row: row.due_at):
+            yield row
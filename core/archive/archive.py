@@ -0,0 +1,58 @@
+# core/archive/archive.py
+
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+
+from core.db.storage import Storage
+from core.metrics.metrics import metrics
+from core.settings.settings import settings
+
+logger = logging.getLogger(__name__)
+
+
+class Archiver:
+    """
+    Периодически переносит завершенные воронки в архив.
+
+    Перенос идет небольшими пачками с паузами, чтобы горячие таблицы
+    оставались размером с активные воронки, а планировщик не ждал соединений.
+    """
+
+    def __init__(self, db):
+        self.db: Storage = db
+
+    async def archive(self) -> int:
+        """
+        Переносит в архив все воронки, завершенные раньше срока archive_after,
+        и удаляет архив старше archive_retention.
+
+        :return: Количество перенесенных пользователей
+        """
+        now = datetime.now(timezone.utc)
+        before = now - timedelta(seconds=settings.archive_after)
+        total = 0
+        while True:
+            moved = await self.db.archive_users(before, settings.archive_batch_size)
+            total += moved
+            metrics.archived_users.inc(moved)
+            if moved < settings.archive_batch_size:
+                break
+            await asyncio.sleep(settings.archive_batch_pause)
+
+        if settings.archive_retention:
+            await self.db.purge_archive(now - timedelta(seconds=settings.archive_retention))
+        return total
+
+    async def run(self):
+        """
+        Запускает перенос в архив каждые archive_interval секунд.
+        """
+        while True:
+            try:
+                archived = await self.archive()
+                if archived:
+                    logger.info("Перенесено в архив пользователей: %s", archived)
+            except Exception:
+                logger.exception("Не удалось перенести завершенные воронки в архив")
+            await asyncio.sleep(settings.archive_interval)
@@ -1,14 +1,41 @@
 # client/client.py
 
+import time
+from typing import Optional
+
 from pyrogram import Client
+from pyrogram.errors import FloodWait, RPCError, SlowmodeWait
+from core.client.governor import SendGovernor
+from core.metrics.metrics import metrics
 from core.settings.settings import settings
 
+# Ошибки Telegram, после которых повторять отправку этому пользователю бессмысленно
+PERMANENT_SEND_ERRORS = {
+    "CHAT_WRITE_FORBIDDEN",
+    "INPUT_USER_DEACTIVATED",
+    "PEER_ID_INVALID",
+    "USER_IS_BLOCKED",
+    "USER_IS_BOT",
+}
+
+
+class SendRejected(Exception):
+    """Отправка невозможна, повторять ее не нужно"""
+
+    def __init__(self, chat_id: int, reason: str):
+        super().__init__(f"Отправка в чат {chat_id} отклонена: {reason}")
+        self.chat_id = chat_id
+        self.reason = reason
+
 
 class TelegramClient:
-    def __init__(self):
-        self.client = Client(
-            name="sessions/my_bot", api_id=settings.bot_api, api_hash=settings.bot_hash
+    def __init__(self, client: Optional[Client] = None):
+        self.client = client or Client(
+            name=f"sessions/{settings.session_name}",
+            api_id=settings.bot_api,
+            api_hash=settings.bot_hash,
         )
+        self.governor = SendGovernor()
 
     async def start(self):
         """
@@ -24,12 +51,28 @@ class TelegramClient:
 
     async def send_message(self, chat_id: int, text: str):
         """
-        Отправляет сообщение пользователю.
+        Отправляет сообщение пользователю с учетом ограничений скорости.
 
         :param chat_id: ID чата
         :param text: Текст сообщения
+        :raises SendThrottled: Если отправку нужно повторить позже
+        :raises SendRejected: Если Telegram окончательно отклонил отправку
         """
-        await self.client.send_message(chat_id, text)
+        await self.governor.acquire(chat_id)
+        started_at = time.perf_counter()
+        try:
+            await self.client.send_message(chat_id, text)
+        except (FloodWait, SlowmodeWait) as e:
+            metrics.flood_waits.inc(label=type(e).__name__)
+            raise self.governor.on_flood_wait(chat_id, e) from e
+        except RPCError as e:
+            if e.ID not in PERMANENT_SEND_ERRORS:
+                raise
+            metrics.send_rejections.inc(label=e.ID)
+            raise SendRejected(chat_id, e.ID) from e
+        finally:
+            metrics.send_seconds.observe(time.perf_counter() - started_at)
+        metrics.sends.inc()
 
     async def get_chat_history(self, chat_id: int, limit: int = 10):
         """
@@ -39,5 +82,7 @@ class TelegramClient:
         :param limit: Количество сообщений для получения
         :return: Список сообщений
         """
+        started_at = time.perf_counter()
         chats = [chat async for chat in self.client.get_chat_history(chat_id, limit)]
+        metrics.history_seconds.observe(time.perf_counter() - started_at)
         return chats
@@ -0,0 +1,142 @@
+# core/client/governor.py
+
+import asyncio
+import time
+from collections import OrderedDict
+
+from pyrogram.errors import FloodWait, SlowmodeWait
+from core.settings.settings import settings
+
+
+class SendThrottled(Exception):
+    """Отправка отложена ограничителем, ее нужно повторить позже"""
+
+    def __init__(self, chat_id: int, retry_after: float):
+        super().__init__(f"Отправка в чат {chat_id} отложена на {retry_after:.1f} с")
+        self.chat_id = chat_id
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def delay(self) -> float:
+        """
+        Возвращает время ожидания до появления свободного токена.
+
+        :return: Количество секунд, 0 если токен доступен сразу
+        """
+        self._refill(time.monotonic())
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self):
+        """
+        Забирает один токен.
+        """
+        self._refill(time.monotonic())
+        self.tokens -= 1
+
+
+class SendGovernor:
+    def __init__(self):
+        self.rate = settings.send_global_rate
+        self.global_bucket = TokenBucket(self.rate, settings.send_global_burst)
+        self.chat_buckets: OrderedDict[int, TokenBucket] = OrderedDict()
+        self.global_paused_until = 0.0
+        self.chat_paused_until: dict[int, float] = {}
+        self.last_increase_at = time.monotonic()
+
+    def global_pause(self) -> float:
+        """
+        Возвращает оставшееся время общей паузы после FloodWait.
+
+        :return: Количество секунд, 0 если пауза не действует
+        """
+        return max(0.0, self.global_paused_until - time.monotonic())
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(settings.send_chat_rate, settings.send_chat_burst)
+            self.chat_buckets[chat_id] = bucket
+            if len(self.chat_buckets) > settings.send_chat_buckets_max:
+                self.chat_buckets.popitem(last=False)
+        else:
+            self.chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    def _set_rate(self, rate: float):
+        self.rate = min(settings.send_global_rate, max(settings.send_rate_min, rate))
+        self.global_bucket.rate = self.rate
+
+    def _recover(self, now: float):
+        # Аддитивное восстановление: доля максимальной скорости за каждый
+        # интервал без FloodWait, отсчет идет от конца последней паузы
+        interval = settings.send_rate_recovery_interval
+        quiet_since = max(self.last_increase_at, self.global_paused_until)
+        if now - quiet_since >= interval:
+            steps = (now - quiet_since) // interval
+            self._set_rate(
+                self.rate + settings.send_global_rate * settings.send_rate_recovery_step * steps
+            )
+            self.last_increase_at = quiet_since + steps * interval
+
+    async def acquire(self, chat_id: int):
+        """
+        Ждет разрешения на отправку в чат.
+
+        :param chat_id: ID чата
+        :raises SendThrottled: Если отправку в чат нужно отложить
+        """
+        now = time.monotonic()
+        if self.global_paused_until > now:
+            raise SendThrottled(chat_id, self.global_paused_until - now)
+
+        chat_paused_until = self.chat_paused_until.get(chat_id, 0.0)
+        if chat_paused_until > now:
+            raise SendThrottled(chat_id, chat_paused_until - now)
+        self.chat_paused_until.pop(chat_id, None)
+
+        chat_bucket = self._chat_bucket(chat_id)
+        chat_delay = chat_bucket.delay()
+        if chat_delay > 0:
+            raise SendThrottled(chat_id, chat_delay)
+
+        self._recover(now)
+        while (delay := self.global_bucket.delay()) > 0:
+            await asyncio.sleep(delay)
+            if self.global_paused_until > time.monotonic():
+                raise SendThrottled(chat_id, self.global_paused_until - time.monotonic())
+
+        self.global_bucket.consume()
+        chat_bucket.consume()
+
+    def on_flood_wait(self, chat_id: int, error: FloodWait | SlowmodeWait) -> SendThrottled:
+        """
+        Учитывает FloodWait: приостанавливает отправку и снижает скорость.
+
+        :param chat_id: ID чата
+        :param error: Ошибка Telegram
+        :return: Исключение для переноса отправки
+        """
+        now = time.monotonic()
+        wait = float(error.value)
+        if isinstance(error, SlowmodeWait):
+            self.chat_paused_until[chat_id] = now + wait
+        else:
+            # Параллельные отправки получают FloodWait одной волной,
+            # скорость снижается один раз за эпизод
+            if now >= self.global_paused_until:
+                self._set_rate(self.rate * settings.send_rate_backoff)
+            self.global_paused_until = max(self.global_paused_until, now + wait)
+        return SendThrottled(chat_id, wait)
@@ -0,0 +1,72 @@
+# core/db/cache.py
+
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from core.db.models import User
+
+
+class UserCache:
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._users: OrderedDict[int, tuple[float, User]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._users)
+
+    def get(self, user_id: int) -> Optional[User]:
+        """
+        Возвращает пользователя из кэша.
+
+        :param user_id: ID пользователя
+        :return: Объект User или None, если записи нет или она устарела
+        """
+        entry = self._users.get(user_id)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._users[user_id]
+            self.misses += 1
+            return None
+        self._users.move_to_end(user_id)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, user: User):
+        """
+        Сохраняет пользователя в кэш, вытесняя самую старую запись при переполнении.
+
+        :param user: Объект User
+        """
+        self._users[user.id] = (time.monotonic() + self.ttl, user)
+        self._users.move_to_end(user.id)
+        while len(self._users) > self.max_size:
+            self._users.popitem(last=False)
+
+    def peek(self, user_id: int) -> Optional[User]:
+        """
+        Возвращает пользователя без учета в статистике и без продления LRU.
+
+        :param user_id: ID пользователя
+        """
+        entry = self._users.get(user_id)
+        return entry[1] if entry is not None else None
+
+    def invalidate(self, user_id: int):
+        """
+        Удаляет пользователя из кэша.
+
+        :param user_id: ID пользователя
+        """
+        self._users.pop(user_id, None)
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._users),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
@@ -1,227 +1,675 @@
+import asyncio
+
 import asyncpg
 from core.settings.settings import settings
-from core.db.models import User
-from datetime import datetime, timedelta
+from core.db.models import StepRow, User, UserRow
+from core.db.storage import Storage
+from core.metrics.metrics import time_query, timed_query
+from datetime import datetime, timedelta, timezone
+
+
+# Ключ рекомендательной блокировки, под которой создается схема и идет перенос
+SCHEMA_LOCK_ID = 0x66756E6E656C  # "funnel"
+
+
+def _month_start(moment: datetime) -> datetime:
+    return moment.astimezone(timezone.utc).replace(
+        day=1, hour=0, minute=0, second=0, microsecond=0
+    )
+
+
+def _next_month(moment: datetime) -> datetime:
+    return (_month_start(moment) + timedelta(days=32)).replace(day=1)
 
 
-class Database:
+class Database(Storage):
+    """Хранилище в PostgreSQL"""
+
     def __init__(self):
-        self.connection = None
+        super().__init__()
+        self.pool: asyncpg.Pool = None
+        self._archive_partitions: set[datetime] = set()  # месяцы с созданными секциями архива
 
     async def connect(self):
         """
-        Устанавливает соединение с базой данных.
+        Создает пул соединений с базой данных.
         """
-        self.connection = await asyncpg.connect(
+        self.pool = await asyncpg.create_pool(
             user=settings.db_login,
             password=settings.db_pass,
             host=settings.db_ip,
             port=settings.db_port,
-            database="task_test_3",
+            database=settings.db_name,
+            min_size=settings.db_pool_min_size,
+            max_size=settings.db_pool_max_size,
+            max_inactive_connection_lifetime=settings.db_pool_max_inactive_lifetime,
+            command_timeout=settings.db_command_timeout,
+            # Все запросы параметризованы, поэтому каждый готовится один раз
+            # на соединение и дальше берется из кэша подготовленных выражений
+            statement_cache_size=settings.db_statement_cache_size,
         )
 
+        async with self.acquire() as connection:
+            # Схему и перенос выполняет один воркер, остальные ждут его завершения.
+            # pg_advisory_lock ждал бы дольше command_timeout, поэтому блокировка
+            # берется попытками
+            lock_query = "SELECT pg_try_advisory_lock($1)"
+            while not await connection.fetchval(lock_query, SCHEMA_LOCK_ID):
+                await asyncio.sleep(1)
+            try:
+                await self._create_schema(connection)
+                await self.migrate_legacy_messages(settings.migration_batch_size)
+            finally:
+                await connection.execute("SELECT pg_advisory_unlock($1)", SCHEMA_LOCK_ID)
+
+        self._start_flusher()
+
+    async def _create_schema(self, connection: asyncpg.Connection):
+        # CREATE TABLE IF NOT EXISTS не блокирует существующую таблицу, а ALTER TABLE
+        # и CREATE INDEX берут блокировку даже без изменений, поэтому выполняются
+        # только если столбцов или индексов еще нет
+        async def missing_columns(table: str, columns: list[str]) -> bool:
+            found = await connection.fetchval(
+                """
+                SELECT count(*)
+                FROM information_schema.columns
+                WHERE table_schema = current_schema() AND table_name = $1
+                  AND column_name = ANY($2::TEXT[])
+                """,
+                table,
+                columns,
+            )
+            return found < len(columns)
+
+        async def missing_relation(name: str) -> bool:
+            return await connection.fetchval("SELECT to_regclass($1) IS NULL", name)
+
         # Создание таблицы пользователей, если она не существует
-        await self.connection.execute("""
+        await connection.execute("""
             CREATE TABLE IF NOT EXISTS users (
                 id BIGINT PRIMARY KEY UNIQUE,
                 created_at TIMESTAMPTZ NOT NULL,
                 status TEXT NOT NULL,
                 status_updated_at TIMESTAMPTZ NOT NULL,
-                last_message_sent_at TIMESTAMPTZ
+                last_message_sent_at TIMESTAMPTZ,
+                session TEXT
             );
         """)
 
-        # Создание таблицы для сообщений, если она не существует
-        await self.connection.execute("""
-            CREATE TABLE IF NOT EXISTS messages (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT REFERENCES users(id),
-                msg_1 TIMESTAMPTZ,
-                status_msg_1 BOOLEAN NOT NULL DEFAULT FALSE,
-                msg_2 TIMESTAMPTZ,
-                status_msg_2 BOOLEAN NOT NULL DEFAULT FALSE,
-                msg_3 TIMESTAMPTZ,
-                status_msg_3 BOOLEAN NOT NULL DEFAULT FALSE,
-                UNIQUE (user_id)
+        # Сессия Telegram, от имени которой пользователь получает воронку.
+        # Существующие пользователи закрепляются за сессией этого воркера:
+        # DEFAULT с константой не переписывает таблицу
+        if await missing_columns("users", ["session"]):
+            session = await connection.fetchval("SELECT quote_literal($1)", settings.session_name)
+            await connection.execute(f"""
+                ALTER TABLE users ADD COLUMN IF NOT EXISTS session TEXT DEFAULT {session};
+                ALTER TABLE users ALTER COLUMN session DROP DEFAULT;
+            """)
+
+        # Создание таблицы шагов воронки, если она не существует
+        await connection.execute("""
+            CREATE TABLE IF NOT EXISTS funnel_steps (
+                user_id BIGINT NOT NULL REFERENCES users(id),
+                step SMALLINT NOT NULL,
+                due_at TIMESTAMPTZ NOT NULL,
+                sent_at TIMESTAMPTZ,
+                PRIMARY KEY (user_id, step)
             );
         """)
 
-    async def close(self):
+        # Аренда шагов воркерами для работы нескольких процессов
+        if await missing_columns("funnel_steps", ["lease_owner", "lease_expires_at"]):
+            await connection.execute("""
+                ALTER TABLE funnel_steps
+                    ADD COLUMN IF NOT EXISTS lease_owner TEXT,
+                    ADD COLUMN IF NOT EXISTS lease_expires_at TIMESTAMPTZ;
+            """)
+
+        # Частичный индекс только по еще не отправленным сообщениям
+        if await missing_relation("funnel_steps_pending_due_at_idx"):
+            await connection.execute("""
+                CREATE INDEX IF NOT EXISTS funnel_steps_pending_due_at_idx
+                ON funnel_steps (due_at)
+                WHERE sent_at IS NULL;
+            """)
+
+        # Архив завершенных воронок, секционированный по месяцу переноса
+        await connection.execute("""
+            CREATE TABLE IF NOT EXISTS users_archive (
+                id BIGINT NOT NULL,
+                created_at TIMESTAMPTZ NOT NULL,
+                status TEXT NOT NULL,
+                status_updated_at TIMESTAMPTZ NOT NULL,
+                last_message_sent_at TIMESTAMPTZ,
+                archived_at TIMESTAMPTZ NOT NULL
+            ) PARTITION BY RANGE (archived_at);
+        """)
+        if await missing_relation("users_archive_id_idx"):
+            await connection.execute("""
+                CREATE INDEX IF NOT EXISTS users_archive_id_idx ON users_archive (id);
+            """)
+        await connection.execute("""
+            CREATE TABLE IF NOT EXISTS funnel_steps_archive (
+                user_id BIGINT NOT NULL,
+                step SMALLINT NOT NULL,
+                due_at TIMESTAMPTZ NOT NULL,
+                sent_at TIMESTAMPTZ,
+                archived_at TIMESTAMPTZ NOT NULL
+            ) PARTITION BY RANGE (archived_at);
+        """)
+
+    async def _close(self):
+        await self.pool.close()
+
+    def acquire(self):
         """
-        Закрывает соединение с базой данных.
+        Берет соединение из пула с ограничением времени ожидания.
+
+        :return: Асинхронный контекстный менеджер соединения
         """
-        await self.connection.close()
+        return self.pool.acquire(timeout=settings.db_pool_acquire_timeout)
 
-    async def get_user(self, user_id: int) -> User:
+    async def health_check(self) -> bool:
         """
-        Возвращает пользователя по его ID.
+        Проверяет доступность базы данных через пул.
 
-        :param user_id: ID пользователя
-        :return: Объект User или None, если пользователь не найден
+        :return: True, если база данных отвечает на запросы
         """
-        query = "SELECT id, created_at, status, status_updated_at, last_message_sent_at FROM users WHERE id = $1"
-        result = await self.connection.fetchrow(query, user_id)
-        if result:
-            return User(**result)
-        return None
+        try:
+            async with self.acquire() as connection:
+                return await connection.fetchval("SELECT 1") == 1
+        except (asyncpg.PostgresError, OSError, asyncio.TimeoutError):
+            return False
 
-    async def add_user(self, user: User):
+    async def migrate_legacy_messages(self, batch_size: int):
         """
-        Добавляет нового пользователя в базу данных.
+        Переносит расписание из старой таблицы messages (msg_1..msg_3) в funnel_steps.
+
+        Перенос идет небольшими транзакциями и может выполняться на работающей
+        базе. Повторный запуск безопасен, после завершения таблица messages
+        переименовывается в messages_legacy.
 
-        :param user: Объект User
+        :param batch_size: Количество строк messages в одной транзакции
         """
-        async with self.connection.transaction():
+        async with self.acquire() as connection:
+            exists = await connection.fetchval(
+                "SELECT to_regclass('messages') IS NOT NULL"
+            )
+        if not exists:
+            return
+
+        # Точное время отправки в старой схеме не хранилось, берем время по плану
+        query = """
+        WITH batch AS (
+            SELECT user_id, msg_1, status_msg_1, msg_2, status_msg_2, msg_3, status_msg_3
+            FROM messages
+            WHERE user_id > $1
+            ORDER BY user_id
+            LIMIT $2
+        ), moved AS (
+            INSERT INTO funnel_steps (user_id, step, due_at, sent_at)
+            SELECT b.user_id, s.step, s.due_at, CASE WHEN s.sent THEN s.due_at END
+            FROM batch b
+            CROSS JOIN LATERAL (VALUES
+                (1, b.msg_1, b.status_msg_1),
+                (2, b.msg_2, b.status_msg_2),
+                (3, b.msg_3, b.status_msg_3)
+            ) AS s(step, due_at, sent)
+            WHERE s.due_at IS NOT NULL
+            ON CONFLICT (user_id, step) DO NOTHING
+        )
+        SELECT max(user_id) FROM batch
+        """
+        last_user_id = -(2**63)
+        while True:
+            async with self.acquire() as connection, connection.transaction():
+                batch_last_user_id = await connection.fetchval(
+                    query, last_user_id, batch_size
+                )
+            if batch_last_user_id is None:
+                break
+            last_user_id = batch_last_user_id
+
+        async with self.acquire() as connection:
+            # Таблицу мог уже переименовать другой процесс, запущенный без блокировки
+            await connection.execute("ALTER TABLE IF EXISTS messages RENAME TO messages_legacy")
+
+    @timed_query
+    async def _fetch_user(self, user_id: int) -> User:
+        # Архивные пользователи не должны снова попадать в воронку
+        query = """
+        SELECT id, created_at, status, status_updated_at, last_message_sent_at
+        FROM users WHERE id = $1
+        UNION ALL
+        SELECT id, created_at, status, status_updated_at, last_message_sent_at
+        FROM users_archive WHERE id = $1
+        LIMIT 1
+        """
+        async with self.acquire() as connection:
+            result = await connection.fetchrow(query, user_id)
+        if result:
+            return User(**result)
+        return None
+
+    @timed_query
+    async def _insert_user(self, user: User, steps: list[int], due_times: list[datetime]) -> bool:
+        async with self.acquire() as connection, connection.transaction():
             # Добавляем пользователя в таблицу users
             query_users = """
-                INSERT INTO users (id, created_at, status, status_updated_at, last_message_sent_at)
-                VALUES ($1, $2, $3, $4, $5)
+                INSERT INTO users (
+                    id, created_at, status, status_updated_at, last_message_sent_at, session
+                )
+                VALUES ($1, $2, $3, $4, $5, $6)
+                ON CONFLICT (id) DO NOTHING
             """
-            await self.connection.execute(
+            inserted = await connection.execute(
                 query_users,
                 user.id,
                 user.created_at,
                 user.status,
                 user.status_updated_at,
                 user.last_message_sent_at,
+                settings.session_name,
             )
+            if inserted == "INSERT 0 0":
+                return False
 
-            # Вычисление времени следующей отправки для каждого сообщения
-            current_time = datetime.utcnow()
-            interval_1_seconds = settings.interval_1
-            interval_2_seconds = settings.interval_2
-            interval_3_seconds = settings.interval_3
+            # Добавление расписания в таблицу funnel_steps
+            query_steps = """
+                INSERT INTO funnel_steps (user_id, step, due_at)
+                SELECT $1, step, due_at
+                FROM UNNEST($2::SMALLINT[], $3::TIMESTAMPTZ[]) AS s(step, due_at)
+                ON CONFLICT (user_id, step) DO NOTHING
+            """
+            await connection.execute(query_steps, user.id, steps, due_times)
+        return True
 
-            next_message_time_1 = current_time + timedelta(seconds=interval_1_seconds)
-            next_message_time_2 = next_message_time_1 + timedelta(
-                seconds=interval_2_seconds
-            )
-            next_message_time_3 = next_message_time_2 + timedelta(
-                seconds=interval_3_seconds
+    @timed_query
+    async def _insert_users(self, user_ids, created_at, steps, due_times) -> int:
+        # Один запрос на пачку: пользователи и их расписание через UNNEST
+        query = """
+        WITH new_users AS (
+            INSERT INTO users (
+                id, created_at, status, status_updated_at, last_message_sent_at, session
             )
-
-            # Добавление времени следующей отправки в таблицу messages
-            query_messages = """
-                INSERT INTO messages (user_id, msg_1, msg_2, msg_3)
-                VALUES ($1, $2, $3, $4)
-            """
-            await self.connection.execute(
-                query_messages,
-                user.id,
-                next_message_time_1,
-                next_message_time_2,
-                next_message_time_3,
+            SELECT v.id, $2, 'alive', $2, NULL, $5
+            FROM UNNEST($1::BIGINT[]) AS v(id)
+            WHERE NOT EXISTS (SELECT 1 FROM users_archive a WHERE a.id = v.id)
+            ON CONFLICT (id) DO NOTHING
+            RETURNING id
+        ), new_steps AS (
+            INSERT INTO funnel_steps (user_id, step, due_at)
+            SELECT n.id, s.step, s.due_at
+            FROM new_users n
+            CROSS JOIN UNNEST($3::SMALLINT[], $4::TIMESTAMPTZ[]) AS s(step, due_at)
+        )
+        SELECT count(*) FROM new_users
+        """
+        async with self.acquire() as connection:
+            return await connection.fetchval(
+                query, user_ids, created_at, steps, due_times, settings.session_name
             )
 
-    async def update_user_status(self, user_id: int, status: str, updated_at: datetime):
+    @timed_query
+    async def get_user_msg_times(self, user_id: int) -> dict[int, datetime]:
         """
-        Обновляет статус пользователя.
+        Возвращает время отправки сообщений воронки для пользователя.
 
         :param user_id: ID пользователя
-        :param status: Новый статус пользователя
-        :param updated_at: Время обновления статуса
+        :return: Словарь {номер сообщения: время отправки}
         """
         query = """
-        UPDATE users
-        SET status = $2, status_updated_at = $3
-        WHERE id = $1
+        SELECT step, due_at
+        FROM funnel_steps
+        WHERE user_id = $1
+        ORDER BY step
         """
-        await self.connection.execute(query, user_id, status, updated_at)
+        async with self.acquire() as connection:
+            results = await connection.fetch(query, user_id)
+        return {result["step"]: result["due_at"] for result in results}
 
-    async def update_last_message_sent_at(self, user_id: int, sent_at: datetime):
+    async def get_new_users(self, page_size: int):
         """
-        Обновляет время отправки последнего сообщения пользователя.
+        Постранично перебирает новых пользователей, которые еще не получили первое сообщение.
 
-        :param user_id: ID пользователя
-        :param sent_at: Время отправки сообщения
+        :param page_size: Количество строк на одной странице
         """
         query = """
-        UPDATE users
-        SET last_message_sent_at = $2
-        WHERE id = $1
+        SELECT id, created_at, status, status_updated_at, last_message_sent_at
+        FROM users
+        WHERE last_message_sent_at IS NULL AND status = 'alive' AND id > $1
+        ORDER BY id
+        LIMIT $2
         """
-        await self.connection.execute(query, user_id, sent_at)
+        last_id = -(2**63)
+        while True:
+            with time_query("get_new_users"):
+                async with self.acquire() as connection:
+                    results = await connection.fetch(query, last_id, page_size)
+            for result in results:
+                yield UserRow(*result)
+            if len(results) < page_size:
+                return
+            last_id = results[-1]["id"]
 
-    async def get_user_msg_times(self, user_id: int):
+    async def get_users_for_message(self, interval: timedelta, page_size: int):
         """
-        Возвращает время следующей отправки сообщений для пользователя.
+        Постранично перебирает пользователей, которым необходимо отправить следующее сообщение.
 
-        :param user_id: ID пользователя
-        :return: Кортеж из времени следующей отправки для msg_1, msg_2 и msg_3
+        :param interval: Интервал времени с момента последнего отправленного сообщения
+        :param page_size: Количество строк на одной странице
         """
         query = """
-        SELECT msg_1, msg_2, msg_3
-        FROM messages
-        WHERE user_id = $1
+        SELECT u.id, u.created_at, u.status, u.status_updated_at, u.last_message_sent_at
+        FROM users u
+        WHERE u.status = 'alive' AND u.id > $2 AND EXISTS (
+            SELECT 1
+            FROM funnel_steps s
+            WHERE s.user_id = u.id
+              AND s.sent_at IS NULL
+              AND s.due_at <= NOW() - $1::INTERVAL
+        )
+        ORDER BY u.id
+        LIMIT $3
         """
-        result = await self.connection.fetchrow(query, user_id)
-        if result:
-            return {
-                "msg_1": result["msg_1"],
-                "msg_2": result["msg_2"],
-                "msg_3": result["msg_3"],
-            }
-        return {"msg_1": None, "msg_2": None, "msg_3": None}
+        last_id = -(2**63)
+        while True:
+            with time_query("get_users_for_message"):
+                async with self.acquire() as connection:
+                    results = await connection.fetch(query, interval, last_id, page_size)
+            for result in results:
+                yield UserRow(*result)
+            if len(results) < page_size:
+                return
+            last_id = results[-1]["id"]
 
-    async def get_new_users(self):
+    async def get_users_to_send_messages(self, page_size: int):
         """
-        Возвращает новых пользователей, которые еще не получили первое сообщение.
+        Постранично перебирает сообщения воронки, время отправки которых уже наступило.
+
+        :param page_size: Количество строк на одной странице
+        :return: Асинхронный генератор StepRow
         """
         query = """
-        SELECT id, created_at, status, status_updated_at, last_message_sent_at
-        FROM users
-        WHERE last_message_sent_at IS NULL AND status = 'alive'
+        SELECT s.user_id, s.step, s.due_at
+        FROM funnel_steps s
+        JOIN users u ON s.user_id = u.id
+        WHERE s.sent_at IS NULL AND s.due_at <= $1 AND u.status = 'alive'
+          AND (s.due_at, s.user_id, s.step) > ($2, $3, $4)
+        ORDER BY s.due_at, s.user_id, s.step
+        LIMIT $5
         """
-        results = await self.connection.fetch(query)
-        return [User(**result) for result in results]
+        # Граница фиксируется один раз, чтобы страницы не догоняли новые строки
+        now = datetime.now(timezone.utc)
+        last_key = (datetime.min.replace(tzinfo=timezone.utc), -(2**63), 0)
+        while True:
+            with time_query("get_users_to_send_messages"):
+                async with self.acquire() as connection:
+                    results = await connection.fetch(query, now, *last_key, page_size)
+            for result in results:
+                yield StepRow(*result)
+            if len(results) < page_size:
+                return
+            last = results[-1]
+            last_key = (last["due_at"], last["user_id"], last["step"])
 
-    async def get_users_for_message(self, interval: timedelta):
+    @timed_query
+    async def _claim_due_steps(self, owner: str, limit: int, lease_seconds: float):
         """
-        Возвращает пользователей, которым необходимо отправить следующее сообщение.
+        Арендует наступившие сообщения воронки для отправки этим воркером.
 
-        :param interval: Интервал времени с момента последнего отправленного сообщения
+        Строки, заблокированные другими воркерами, пропускаются (SKIP LOCKED).
+        Аренда с истекшим сроком считается свободной, поэтому шаги упавшего
+        воркера подхватываются остальными. Для каждого пользователя арендуется
+        только самый ранний неотправленный шаг. Арендуются только пользователи
+        сессии этого воркера: другой аккаунт не может писать в их чаты.
+
+        :param owner: Идентификатор воркера
+        :param limit: Максимальное количество шагов
+        :param lease_seconds: Срок аренды в секундах
+        :return: Список StepRow
         """
-        interval_seconds = int(interval.total_seconds())
-        query = f"""
-        SELECT u.id, u.created_at, u.status, u.status_updated_at, u.last_message_sent_at
-        FROM users u
-        JOIN messages m ON u.id = m.user_id
-        WHERE u.status = 'alive' AND (
-            (m.msg_1 IS NULL OR m.msg_1 <= NOW() - INTERVAL '{interval_seconds} seconds') OR
-            (m.msg_2 IS NULL OR m.msg_2 <= NOW() - INTERVAL '{interval_seconds} seconds') OR
-            (m.msg_3 IS NULL OR m.msg_3 <= NOW() - INTERVAL '{interval_seconds} seconds')
+        query = """
+        WITH due AS (
+            SELECT s.user_id, s.step
+            FROM funnel_steps s
+            JOIN users u ON u.id = s.user_id
+            WHERE s.sent_at IS NULL AND s.due_at <= NOW() AND u.status = 'alive'
+              AND u.session = $4
+              AND (s.lease_expires_at IS NULL OR s.lease_expires_at < NOW())
+              AND NOT EXISTS (
+                  SELECT 1
+                  FROM funnel_steps p
+                  WHERE p.user_id = s.user_id AND p.step < s.step AND p.sent_at IS NULL
+              )
+            ORDER BY s.due_at
+            LIMIT $2
+            FOR UPDATE OF s SKIP LOCKED
         )
+        UPDATE funnel_steps s
+        SET lease_owner = $1, lease_expires_at = NOW() + make_interval(secs => $3)
+        FROM due
+        WHERE s.user_id = due.user_id AND s.step = due.step
+        RETURNING s.user_id, s.step, s.due_at
         """
-        results = await self.connection.fetch(query)
-        return [User(**result) for result in results]
+        async with self.acquire() as connection:
+            results = await connection.fetch(
+                query, owner, limit, float(lease_seconds), settings.session_name
+            )
+        return [StepRow(*result) for result in results]
 
-    async def get_users_to_send_messages(self):
+    @timed_query
+    async def _mark_sent(self, user_id: int, step: int, owner: str, sent_at: datetime) -> bool:
+        query = """
+        WITH sent AS (
+            UPDATE funnel_steps
+            SET sent_at = $4, lease_owner = NULL, lease_expires_at = NULL
+            WHERE user_id = $1 AND step = $2 AND lease_owner = $3 AND sent_at IS NULL
+            RETURNING user_id
+        ), last_sent AS (
+            UPDATE users u
+            SET last_message_sent_at = $4
+            FROM sent
+            WHERE u.id = sent.user_id
+              AND (u.last_message_sent_at IS NULL OR u.last_message_sent_at < $4)
+        )
+        SELECT count(*) FROM sent
         """
-        Возвращает пользователей, которым необходимо отправить сообщения.
+        async with self.acquire() as connection:
+            return await connection.fetchval(query, user_id, step, owner, sent_at) > 0
+
+    @timed_query
+    async def release_step(self, user_id: int, step: int, owner: str, retry_at: datetime):
         """
+        Возвращает арендованный шаг, запрещая повторную аренду до retry_at.
+
+        :param user_id: ID пользователя
+        :param step: Номер сообщения
+        :param owner: Идентификатор воркера
+        :param retry_at: Время, после которого шаг можно арендовать снова
+        """
+        query = """
+        UPDATE funnel_steps
+        SET lease_owner = NULL, lease_expires_at = $4
+        WHERE user_id = $1 AND step = $2 AND lease_owner = $3 AND sent_at IS NULL
+        """
+        async with self.acquire() as connection:
+            await connection.execute(query, user_id, step, owner, retry_at)
+
+    @timed_query
+    async def _write_updates(self, sent_steps, last_sent, statuses):
+        async with self.acquire() as connection, connection.transaction():
+            if sent_steps:
+                await connection.execute(
+                    """
+                    UPDATE funnel_steps s
+                    SET sent_at = v.sent_at, lease_owner = NULL, lease_expires_at = NULL
+                    FROM UNNEST($1::BIGINT[], $2::SMALLINT[], $3::TIMESTAMPTZ[])
+                        AS v(user_id, step, sent_at)
+                    WHERE s.user_id = v.user_id AND s.step = v.step
+                    """,
+                    [user_id for user_id, _ in sent_steps],
+                    [step for _, step in sent_steps],
+                    list(sent_steps.values()),
+                )
+            if last_sent:
+                await connection.execute(
+                    """
+                    UPDATE users u
+                    SET last_message_sent_at = GREATEST(u.last_message_sent_at, v.sent_at)
+                    FROM UNNEST($1::BIGINT[], $2::TIMESTAMPTZ[]) AS v(id, sent_at)
+                    WHERE u.id = v.id
+                    """,
+                    list(last_sent),
+                    list(last_sent.values()),
+                )
+            if statuses:
+                await connection.execute(
+                    """
+                    UPDATE users u
+                    SET status = v.status, status_updated_at = v.updated_at
+                    FROM UNNEST($1::BIGINT[], $2::TEXT[], $3::TIMESTAMPTZ[])
+                        AS v(id, status, updated_at)
+                    WHERE u.id = v.id
+                    """,
+                    list(statuses),
+                    [status for status, _ in statuses.values()],
+                    [updated_at for _, updated_at in statuses.values()],
+                )
+
+    async def _ensure_archive_partition(self, moment: datetime):
+        start = _month_start(moment)
+        if start in self._archive_partitions:
+            return
+        end = _next_month(start)
+        async with self.acquire() as connection:
+            for table in ("users_archive", "funnel_steps_archive"):
+                # DDL не параметризуется, имя и границы строятся только из даты
+                await connection.execute(
+                    f"CREATE TABLE IF NOT EXISTS {table}_p{start:%Y_%m} PARTITION OF {table} "
+                    f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+                )
+        self._archive_partitions.add(start)
+
+    @timed_query
+    async def archive_users(self, before: datetime, limit: int) -> int:
+        """
+        Переносит пачку завершенных воронок в архив одним запросом.
+
+        Строки, заблокированные воркерами, и шаги с действующей арендой
+        пропускаются, поэтому перенос не ждет планировщик.
+
+        :param before: Воронки, завершенные раньше этого времени, переносятся в архив
+        :param limit: Максимальное количество пользователей в пачке
+        :return: Количество перенесенных пользователей
+        """
+        archived_at = datetime.now(timezone.utc)
+        await self._ensure_archive_partition(archived_at)
+        # Внешний ключ funnel_steps проверяется в конце запроса, когда удалены обе строки
         query = """
-        SELECT m.user_id, u.status, m.msg_1, m.status_msg_1, m.msg_2, m.status_msg_2, m.msg_3, m.status_msg_3
-        FROM messages m
-        JOIN users u ON m.user_id = u.id
-        WHERE u.status = 'alive' AND (
-            (m.msg_1 IS NOT NULL AND m.msg_1 <= NOW() AND m.status_msg_1 = FALSE) OR
-            (m.msg_2 IS NOT NULL AND m.msg_2 <= NOW() AND m.status_msg_2 = FALSE) OR
-            (m.msg_3 IS NOT NULL AND m.msg_3 <= NOW() AND m.status_msg_3 = FALSE)
+        WITH candidates AS (
+            SELECT u.id
+            FROM users u
+            WHERE (
+                (u.status = 'finished' AND u.status_updated_at < $1)
+                OR (
+                    u.status = 'alive' AND u.last_message_sent_at < $1
+                    AND NOT EXISTS (
+                        SELECT 1 FROM funnel_steps s WHERE s.user_id = u.id AND s.sent_at IS NULL
+                    )
+                )
+            )
+            AND NOT EXISTS (
+                SELECT 1 FROM funnel_steps s WHERE s.user_id = u.id AND s.lease_expires_at > NOW()
+            )
+            ORDER BY u.id
+            LIMIT $2
+            FOR UPDATE SKIP LOCKED
+        ), moved_steps AS (
+            DELETE FROM funnel_steps s
+            USING candidates c
+            WHERE s.user_id = c.id
+            RETURNING s.user_id, s.step, s.due_at, s.sent_at
+        ), archived_steps AS (
+            INSERT INTO funnel_steps_archive (user_id, step, due_at, sent_at, archived_at)
+            SELECT user_id, step, due_at, sent_at, $3 FROM moved_steps
+        ), moved_users AS (
+            DELETE FROM users u
+            USING candidates c
+            WHERE u.id = c.id
+            RETURNING u.id, u.created_at, u.status, u.status_updated_at, u.last_message_sent_at
+        )
+        INSERT INTO users_archive (
+            id, created_at, status, status_updated_at, last_message_sent_at, archived_at
         )
+        SELECT id, created_at, status, status_updated_at, last_message_sent_at, $3
+        FROM moved_users
         """
-        results = await self.connection.fetch(query)
-        return results
+        async with self.acquire() as connection:
+            result = await connection.execute(query, before, limit, archived_at)
+        return int(result.split()[-1])
 
-    async def update_message_status(self, user_id: int, msg_number: int):
+    async def purge_archive(self, before: datetime):
         """
-        Обновляет статус отправленного сообщения для пользователя.
+        Удаляет секции архива, целиком попадающие в период до before.
 
-        :param user_id: ID пользователя
-        :param msg_number: Номер сообщения (1, 2 или 3)
+        :param before: Граница срока хранения архива
         """
-        query = f"""
-        UPDATE messages
-        SET status_msg_{msg_number} = TRUE
-        WHERE user_id = $1
+        query = """
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = $1::REGCLASS
+        """
+        for table in ("users_archive", "funnel_steps_archive"):
+            async with self.acquire() as connection:
+                partitions = [result["relname"] for result in await connection.fetch(query, table)]
+            for partition in partitions:
+                try:
+                    start = datetime.strptime(
+                        partition.removeprefix(f"{table}_p"), "%Y_%m"
+                    ).replace(tzinfo=timezone.utc)
+                except ValueError:
+                    # Секции, созданные вручную, не трогаем
+                    continue
+                if _next_month(start) > before:
+                    continue
+                async with self.acquire() as connection:
+                    await connection.execute(f"DROP TABLE IF EXISTS {partition}")
+                self._archive_partitions.discard(start)
+
+    async def iter_pending_messages(self, until: datetime, page_size: int):
+        """
+        Постранично перебирает следующие неотправленные сообщения активных
+        пользователей со временем отправки не позже until.
+
+        :param until: Граница времени отправки
+        :param page_size: Количество строк на одной странице
+        :return: Асинхронный генератор StepRow
+        """
+        query = """
+        SELECT s.user_id, s.step, s.due_at
+        FROM funnel_steps s
+        JOIN users u ON s.user_id = u.id
+        WHERE s.sent_at IS NULL AND u.status = 'alive' AND s.due_at <= $4 AND u.session = $5
+          AND NOT EXISTS (
+              SELECT 1 FROM funnel_steps e
+              WHERE e.user_id = s.user_id AND e.step < s.step AND e.sent_at IS NULL
+          )
+          AND (s.due_at, s.user_id, s.step) > ($1, $2, $3)
+        ORDER BY s.due_at, s.user_id, s.step
+        LIMIT $6
         """
-        await self.connection.execute(query, user_id)
+        last_key = (datetime.min.replace(tzinfo=timezone.utc), -(2**63), 0)
+        while True:
+            with time_query("iter_pending_messages"):
+                async with self.acquire() as connection:
+                    results = await connection.fetch(
+                        query, *last_key, until, settings.session_name, page_size
+                    )
+            for result in results:
+                yield StepRow(*result)
+            if len(results) < page_size:
+                return
+            last = results[-1]
+            last_key = (last["due_at"], last["user_id"], last["step"])
@@ -2,7 +2,7 @@
 
 from pydantic import BaseModel
 from datetime import datetime
-from typing import Optional
+from typing import NamedTuple, Optional
 
 
 class User(BaseModel):
@@ -10,4 +10,26 @@ class User(BaseModel):
     created_at: datetime
     status: str
     status_updated_at: datetime
-    last_message_sent_at: Optional[datetime] = None
\ No newline at end of file
+    last_message_sent_at: Optional[datetime] = None
+
+
+# Строки массовых выборок: без валидации pydantic, поэтому на порядок дешевле
+# при переборе больших выборок. User остается для одиночных запросов и API.
+class UserRow(NamedTuple):
+    id: int
+    created_at: datetime
+    status: str
+    status_updated_at: datetime
+    last_message_sent_at: Optional[datetime]
+
+    def to_user(self) -> User:
+        """
+        Возвращает проверенную модель User.
+        """
+        return User(**self._asdict())
+
+
+class StepRow(NamedTuple):
+    user_id: int
+    step: int
+    due_at: datetime
@@ -0,0 +1,583 @@
+# core/db/sqlite.py
+
+import asyncio
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from core.db.models import StepRow, User, UserRow
+from core.db.storage import Storage
+from core.metrics.metrics import time_query, timed_query
+from core.settings.settings import settings
+
+
+def _ts(value: Optional[datetime]) -> Optional[float]:
+    # Время хранится как UNIX-время в секундах, чтобы сравнения шли по индексу
+    return value.timestamp() if value is not None else None
+
+
+def _dt(value: Optional[float]) -> Optional[datetime]:
+    return datetime.fromtimestamp(value, timezone.utc) if value is not None else None
+
+
+def _user(row: sqlite3.Row) -> User:
+    return User(
+        id=row["id"],
+        created_at=_dt(row["created_at"]),
+        status=row["status"],
+        status_updated_at=_dt(row["status_updated_at"]),
+        last_message_sent_at=_dt(row["last_message_sent_at"]),
+    )
+
+
+def _user_row(row: sqlite3.Row) -> UserRow:
+    return UserRow(
+        row["id"],
+        _dt(row["created_at"]),
+        row["status"],
+        _dt(row["status_updated_at"]),
+        _dt(row["last_message_sent_at"]),
+    )
+
+
+def _step_row(row: sqlite3.Row) -> StepRow:
+    return StepRow(row["user_id"], row["step"], _dt(row["due_at"]))
+
+
+class SQLiteDatabase(Storage):
+    """
+    Встроенное хранилище в SQLite (WAL) для однопроцессной установки.
+
+    Все запросы выполняются в отдельном потоке с единственным соединением,
+    поэтому цикл событий не блокируется.
+    """
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+        self.connection: sqlite3.Connection = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+
+    async def _run(self, function, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, function, *args)
+
+    def _transaction(self, function, *args):
+        # BEGIN IMMEDIATE сразу берет блокировку записи, как SKIP LOCKED для одного узла
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            result = function(*args)
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        self.connection.execute("COMMIT")
+        return result
+
+    def _connect(self):
+        self.connection = sqlite3.connect(
+            self.path,
+            isolation_level=None,
+            check_same_thread=False,
+            timeout=settings.db_command_timeout,
+        )
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.execute("PRAGMA synchronous = NORMAL")
+        self.connection.execute("PRAGMA foreign_keys = ON")
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS users (
+                id INTEGER PRIMARY KEY,
+                created_at REAL NOT NULL,
+                status TEXT NOT NULL,
+                status_updated_at REAL NOT NULL,
+                last_message_sent_at REAL,
+                session TEXT
+            );
+
+            CREATE TABLE IF NOT EXISTS funnel_steps (
+                user_id INTEGER NOT NULL REFERENCES users(id),
+                step INTEGER NOT NULL,
+                due_at REAL NOT NULL,
+                sent_at REAL,
+                lease_owner TEXT,
+                lease_expires_at REAL,
+                PRIMARY KEY (user_id, step)
+            ) WITHOUT ROWID;
+
+            CREATE INDEX IF NOT EXISTS funnel_steps_pending_due_at_idx
+            ON funnel_steps (due_at)
+            WHERE sent_at IS NULL;
+
+            CREATE TABLE IF NOT EXISTS users_archive (
+                id INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                status TEXT NOT NULL,
+                status_updated_at REAL NOT NULL,
+                last_message_sent_at REAL,
+                archived_at REAL NOT NULL
+            );
+
+            CREATE INDEX IF NOT EXISTS users_archive_id_idx ON users_archive (id);
+            CREATE INDEX IF NOT EXISTS users_archive_archived_at_idx
+            ON users_archive (archived_at);
+
+            CREATE TABLE IF NOT EXISTS funnel_steps_archive (
+                user_id INTEGER NOT NULL,
+                step INTEGER NOT NULL,
+                due_at REAL NOT NULL,
+                sent_at REAL,
+                archived_at REAL NOT NULL
+            );
+
+            CREATE INDEX IF NOT EXISTS funnel_steps_archive_archived_at_idx
+            ON funnel_steps_archive (archived_at);
+        """)
+
+        # Сессия Telegram, от имени которой пользователь получает воронку.
+        # Существующие пользователи закрепляются за сессией этого процесса
+        columns = {row["name"] for row in self.connection.execute("PRAGMA table_info(users)")}
+        if "session" not in columns:
+            self._transaction(self._add_session_column)
+
+    def _add_session_column(self):
+        self.connection.execute("ALTER TABLE users ADD COLUMN session TEXT")
+        self.connection.execute("UPDATE users SET session = ?", (settings.session_name,))
+
+    async def connect(self):
+        """
+        Открывает файл базы данных в режиме WAL и создает схему.
+        """
+        await self._run(self._connect)
+        self._start_flusher()
+
+    async def _close(self):
+        await self._run(self.connection.close)
+        self._executor.shutdown(wait=True)
+
+    async def health_check(self) -> bool:
+        """
+        Проверяет доступность базы данных.
+
+        :return: True, если база данных отвечает на запросы
+        """
+        try:
+            row = await self._run(lambda: self.connection.execute("SELECT 1").fetchone())
+            return row[0] == 1
+        except sqlite3.Error:
+            return False
+
+    @timed_query
+    async def _fetch_user(self, user_id: int) -> Optional[User]:
+        def fetch():
+            # Архивные пользователи не должны снова попадать в воронку
+            return self.connection.execute(
+                """
+                SELECT id, created_at, status, status_updated_at, last_message_sent_at
+                FROM users WHERE id = ?
+                UNION ALL
+                SELECT id, created_at, status, status_updated_at, last_message_sent_at
+                FROM users_archive WHERE id = ?
+                LIMIT 1
+                """,
+                (user_id, user_id),
+            ).fetchone()
+
+        row = await self._run(fetch)
+        return _user(row) if row else None
+
+    @timed_query
+    async def _insert_user(self, user: User, steps: list[int], due_times: list[datetime]) -> bool:
+        def insert():
+            cursor = self.connection.execute(
+                """
+                INSERT INTO users (
+                    id, created_at, status, status_updated_at, last_message_sent_at, session
+                )
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (id) DO NOTHING
+                """,
+                (
+                    user.id,
+                    _ts(user.created_at),
+                    user.status,
+                    _ts(user.status_updated_at),
+                    _ts(user.last_message_sent_at),
+                    settings.session_name,
+                ),
+            )
+            if cursor.rowcount == 0:
+                return False
+            self.connection.executemany(
+                """
+                INSERT INTO funnel_steps (user_id, step, due_at)
+                VALUES (?, ?, ?)
+                ON CONFLICT (user_id, step) DO NOTHING
+                """,
+                [(user.id, step, _ts(due_at)) for step, due_at in zip(steps, due_times)],
+            )
+            return True
+
+        return await self._run(self._transaction, insert)
+
+    @timed_query
+    async def _insert_users(self, user_ids, created_at, steps, due_times) -> int:
+        def insert():
+            inserted = []
+            for user_id in user_ids:
+                cursor = self.connection.execute(
+                    """
+                    INSERT INTO users (
+                        id, created_at, status, status_updated_at, last_message_sent_at, session
+                    )
+                    SELECT ?, ?, 'alive', ?, NULL, ?
+                    WHERE NOT EXISTS (SELECT 1 FROM users_archive WHERE id = ?)
+                    ON CONFLICT (id) DO NOTHING
+                    """,
+                    (user_id, _ts(created_at), _ts(created_at), settings.session_name, user_id),
+                )
+                if cursor.rowcount:
+                    inserted.append(user_id)
+            self.connection.executemany(
+                "INSERT INTO funnel_steps (user_id, step, due_at) VALUES (?, ?, ?)",
+                [
+                    (user_id, step, _ts(due_at))
+                    for user_id in inserted
+                    for step, due_at in zip(steps, due_times)
+                ],
+            )
+            return len(inserted)
+
+        return await self._run(self._transaction, insert)
+
+    @timed_query
+    async def _write_updates(self, sent_steps, last_sent, statuses):
+        def write():
+            self.connection.executemany(
+                """
+                UPDATE funnel_steps
+                SET sent_at = ?, lease_owner = NULL, lease_expires_at = NULL
+                WHERE user_id = ? AND step = ?
+                """,
+                [(_ts(sent_at), user_id, step) for (user_id, step), sent_at in sent_steps.items()],
+            )
+            self.connection.executemany(
+                """
+                UPDATE users
+                SET last_message_sent_at = MAX(COALESCE(last_message_sent_at, 0), ?)
+                WHERE id = ?
+                """,
+                [(_ts(sent_at), user_id) for user_id, sent_at in last_sent.items()],
+            )
+            self.connection.executemany(
+                "UPDATE users SET status = ?, status_updated_at = ? WHERE id = ?",
+                [
+                    (status, _ts(updated_at), user_id)
+                    for user_id, (status, updated_at) in statuses.items()
+                ],
+            )
+
+        await self._run(self._transaction, write)
+
+    @timed_query
+    async def get_user_msg_times(self, user_id: int) -> dict[int, datetime]:
+        """
+        Возвращает время отправки сообщений воронки для пользователя.
+
+        :param user_id: ID пользователя
+        :return: Словарь {номер сообщения: время отправки}
+        """
+        def fetch():
+            return self.connection.execute(
+                "SELECT step, due_at FROM funnel_steps WHERE user_id = ? ORDER BY step",
+                (user_id,),
+            ).fetchall()
+
+        return {row["step"]: _dt(row["due_at"]) for row in await self._run(fetch)}
+
+    async def _pages(self, name: str, query: str, args: tuple, key, last_key, page_size: int):
+        # Постраничное чтение по ключу: соединение не занято, пока потребитель обрабатывает строки
+        def fetch(last_key):
+            return self.connection.execute(query, (*args, *last_key, page_size)).fetchall()
+
+        while True:
+            with time_query(name):
+                rows = await self._run(fetch, last_key)
+            for row in rows:
+                yield row
+            if len(rows) < page_size:
+                return
+            last_key = key(rows[-1])
+
+    async def get_new_users(self, page_size: int):
+        """
+        Постранично перебирает новых пользователей, которые еще не получили первое сообщение.
+
+        :param page_size: Количество строк на одной странице
+        """
+        query = """
+        SELECT id, created_at, status, status_updated_at, last_message_sent_at
+        FROM users
+        WHERE last_message_sent_at IS NULL AND status = 'alive' AND id > ?
+        ORDER BY id
+        LIMIT ?
+        """
+        async for row in self._pages(
+            "get_new_users", query, (), lambda row: (row["id"],), (-(2**63),), page_size
+        ):
+            yield _user_row(row)
+
+    async def get_users_for_message(self, interval: timedelta, page_size: int):
+        """
+        Постранично перебирает пользователей, которым необходимо отправить следующее сообщение.
+
+        :param interval: Интервал времени с момента последнего отправленного сообщения
+        :param page_size: Количество строк на одной странице
+        """
+        query = """
+        SELECT u.id, u.created_at, u.status, u.status_updated_at, u.last_message_sent_at
+        FROM users u
+        WHERE u.status = 'alive' AND EXISTS (
+            SELECT 1
+            FROM funnel_steps s
+            WHERE s.user_id = u.id AND s.sent_at IS NULL AND s.due_at <= ?
+        ) AND u.id > ?
+        ORDER BY u.id
+        LIMIT ?
+        """
+        threshold = _ts(datetime.now(timezone.utc) - interval)
+        async for row in self._pages(
+            "get_users_for_message",
+            query,
+            (threshold,),
+            lambda row: (row["id"],),
+            (-(2**63),),
+            page_size,
+        ):
+            yield _user_row(row)
+
+    async def get_users_to_send_messages(self, page_size: int):
+        """
+        Постранично перебирает сообщения воронки, время отправки которых уже наступило.
+
+        :param page_size: Количество строк на одной странице
+        :return: Асинхронный генератор StepRow
+        """
+        query = """
+        SELECT s.user_id, s.step, s.due_at
+        FROM funnel_steps s
+        JOIN users u ON s.user_id = u.id
+        WHERE s.sent_at IS NULL AND s.due_at <= ? AND u.status = 'alive'
+          AND (s.due_at, s.user_id, s.step) > (?, ?, ?)
+        ORDER BY s.due_at, s.user_id, s.step
+        LIMIT ?
+        """
+        now = _ts(datetime.now(timezone.utc))
+        async for row in self._pages(
+            "get_users_to_send_messages",
+            query,
+            (now,),
+            lambda row: (row["due_at"], row["user_id"], row["step"]),
+            (float("-inf"), -(2**63), 0),
+            page_size,
+        ):
+            yield _step_row(row)
+
+    @timed_query
+    async def _claim_due_steps(self, owner: str, limit: int, lease_seconds: float):
+        """
+        Арендует наступившие сообщения воронки для отправки этим воркером.
+
+        Для каждого пользователя арендуется только самый ранний неотправленный шаг.
+        Арендуются только пользователи сессии этого процесса.
+
+        :param owner: Идентификатор воркера
+        :param limit: Максимальное количество шагов
+        :param lease_seconds: Срок аренды в секундах
+        :return: Список StepRow
+        """
+        now = _ts(datetime.now(timezone.utc))
+
+        def claim():
+            rows = self.connection.execute(
+                """
+                SELECT s.user_id, s.step, s.due_at
+                FROM funnel_steps s
+                JOIN users u ON u.id = s.user_id
+                WHERE s.sent_at IS NULL AND s.due_at <= ? AND u.status = 'alive'
+                  AND u.session = ?
+                  AND (s.lease_expires_at IS NULL OR s.lease_expires_at < ?)
+                  AND NOT EXISTS (
+                      SELECT 1
+                      FROM funnel_steps p
+                      WHERE p.user_id = s.user_id AND p.step < s.step AND p.sent_at IS NULL
+                  )
+                ORDER BY s.due_at
+                LIMIT ?
+                """,
+                (now, settings.session_name, now, limit),
+            ).fetchall()
+            self.connection.executemany(
+                """
+                UPDATE funnel_steps
+                SET lease_owner = ?, lease_expires_at = ?
+                WHERE user_id = ? AND step = ?
+                """,
+                [(owner, now + lease_seconds, row["user_id"], row["step"]) for row in rows],
+            )
+            return rows
+
+        rows = await self._run(self._transaction, claim)
+        return [_step_row(row) for row in rows]
+
+    @timed_query
+    async def _mark_sent(self, user_id: int, step: int, owner: str, sent_at: datetime) -> bool:
+        def mark():
+            marked = self.connection.execute(
+                """
+                UPDATE funnel_steps
+                SET sent_at = ?, lease_owner = NULL, lease_expires_at = NULL
+                WHERE user_id = ? AND step = ? AND lease_owner = ? AND sent_at IS NULL
+                """,
+                (_ts(sent_at), user_id, step, owner),
+            ).rowcount
+            if marked:
+                self.connection.execute(
+                    """
+                    UPDATE users SET last_message_sent_at = ?
+                    WHERE id = ? AND (last_message_sent_at IS NULL OR last_message_sent_at < ?)
+                    """,
+                    (_ts(sent_at), user_id, _ts(sent_at)),
+                )
+            return marked
+
+        return await self._run(self._transaction, mark) > 0
+
+    @timed_query
+    async def release_step(self, user_id: int, step: int, owner: str, retry_at: datetime):
+        """
+        Возвращает арендованный шаг, запрещая повторную аренду до retry_at.
+
+        :param user_id: ID пользователя
+        :param step: Номер сообщения
+        :param owner: Идентификатор воркера
+        :param retry_at: Время, после которого шаг можно арендовать снова
+        """
+        def release():
+            self.connection.execute(
+                """
+                UPDATE funnel_steps
+                SET lease_owner = NULL, lease_expires_at = ?
+                WHERE user_id = ? AND step = ? AND lease_owner = ? AND sent_at IS NULL
+                """,
+                (_ts(retry_at), user_id, step, owner),
+            )
+
+        await self._run(release)
+
+    @timed_query
+    async def archive_users(self, before: datetime, limit: int) -> int:
+        """
+        Переносит пачку завершенных воронок в архив одной транзакцией.
+
+        :param before: Воронки, завершенные раньше этого времени, переносятся в архив
+        :param limit: Максимальное количество пользователей в пачке
+        :return: Количество перенесенных пользователей
+        """
+        now = datetime.now(timezone.utc)
+
+        def archive():
+            ids = [
+                (row["id"],)
+                for row in self.connection.execute(
+                    """
+                    SELECT u.id
+                    FROM users u
+                    WHERE (
+                        (u.status = 'finished' AND u.status_updated_at < ?)
+                        OR (
+                            u.status = 'alive' AND u.last_message_sent_at < ?
+                            AND NOT EXISTS (
+                                SELECT 1 FROM funnel_steps s
+                                WHERE s.user_id = u.id AND s.sent_at IS NULL
+                            )
+                        )
+                    )
+                    AND NOT EXISTS (
+                        SELECT 1 FROM funnel_steps s
+                        WHERE s.user_id = u.id AND s.lease_expires_at > ?
+                    )
+                    ORDER BY u.id
+                    LIMIT ?
+                    """,
+                    (_ts(before), _ts(before), _ts(now), limit),
+                )
+            ]
+            self.connection.executemany(
+                """
+                INSERT INTO funnel_steps_archive (user_id, step, due_at, sent_at, archived_at)
+                SELECT user_id, step, due_at, sent_at, ? FROM funnel_steps WHERE user_id = ?
+                """,
+                [(_ts(now), user_id) for user_id, in ids],
+            )
+            self.connection.executemany(
+                """
+                INSERT INTO users_archive (
+                    id, created_at, status, status_updated_at, last_message_sent_at, archived_at
+                )
+                SELECT id, created_at, status, status_updated_at, last_message_sent_at, ?
+                FROM users WHERE id = ?
+                """,
+                [(_ts(now), user_id) for user_id, in ids],
+            )
+            self.connection.executemany("DELETE FROM funnel_steps WHERE user_id = ?", ids)
+            self.connection.executemany("DELETE FROM users WHERE id = ?", ids)
+            return len(ids)
+
+        return await self._run(self._transaction, archive)
+
+    async def purge_archive(self, before: datetime):
+        """
+        Удаляет из архива воронки, перенесенные раньше before.
+
+        :param before: Граница срока хранения архива
+        """
+        def purge():
+            self.connection.execute(
+                "DELETE FROM funnel_steps_archive WHERE archived_at < ?", (_ts(before),)
+            )
+            self.connection.execute("DELETE FROM users_archive WHERE archived_at < ?", (_ts(before),))
+
+        await self._run(self._transaction, purge)
+
+    async def iter_pending_messages(self, until: datetime, page_size: int):
+        """
+        Постранично перебирает следующие неотправленные сообщения активных
+        пользователей со временем отправки не позже until.
+
+        :param until: Граница времени отправки
+        :param page_size: Количество строк на одной странице
+        :return: Асинхронный генератор StepRow
+        """
+        query = """
+        SELECT s.user_id, s.step, s.due_at
+        FROM funnel_steps s
+        JOIN users u ON s.user_id = u.id
+        WHERE s.sent_at IS NULL AND u.status = 'alive' AND s.due_at <= ? AND u.session = ?
+          AND NOT EXISTS (
+              SELECT 1 FROM funnel_steps e
+              WHERE e.user_id = s.user_id AND e.step < s.step AND e.sent_at IS NULL
+          )
+          AND (s.due_at, s.user_id, s.step) > (?, ?, ?)
+        ORDER BY s.due_at, s.user_id, s.step
+        LIMIT ?
+        """
+        async for row in self._pages(
+            "iter_pending_messages",
+            query,
+            (_ts(until), settings.session_name),
+            lambda row: (row["due_at"], row["user_id"], row["step"]),
+            (float("-inf"), -(2**63), 0),
+            page_size,
+        ):
+            yield _step_row(row)
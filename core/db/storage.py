@@ -0,0 +1,447 @@
+# core/db/storage.py
+
+import asyncio
+import logging
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta, timezone
+from itertools import islice
+from typing import AsyncIterator, Iterable, Optional
+
+from core.db.cache import UserCache
+from core.db.models import StepRow, User, UserRow
+from core.settings.settings import settings
+
+logger = logging.getLogger(__name__)
+
+
+class Storage(ABC):
+    """
+    Хранилище воронки.
+
+    Общая часть для всех реализаций: кэш пользователей и отложенная запись
+    статусов и времени отправки. Реализации отвечают только за запросы.
+    """
+
+    def __init__(self):
+        self.users = UserCache(settings.user_cache_size, settings.user_cache_ttl)
+        # Отложенная запись: обновления копятся в памяти и сбрасываются пачкой
+        self._sent_steps: dict[tuple[int, int], datetime] = {}
+        self._last_sent: dict[int, datetime] = {}
+        self._statuses: dict[int, tuple[str, datetime]] = {}
+        self._flush_lock = asyncio.Lock()
+        self._flush_needed = asyncio.Event()
+        self._flush_task: asyncio.Task = None
+
+    @abstractmethod
+    async def connect(self):
+        """
+        Подключается к хранилищу и создает схему.
+        """
+
+    @abstractmethod
+    async def _close(self):
+        pass
+
+    @abstractmethod
+    async def health_check(self) -> bool:
+        """
+        Проверяет доступность хранилища.
+
+        :return: True, если хранилище отвечает на запросы
+        """
+
+    @abstractmethod
+    async def _fetch_user(self, user_id: int) -> Optional[User]:
+        pass
+
+    @abstractmethod
+    async def _insert_user(self, user: User, steps: list[int], due_times: list[datetime]) -> bool:
+        """
+        Добавляет пользователя и его расписание одной транзакцией.
+
+        :return: False, если пользователь уже существует
+        """
+
+    @abstractmethod
+    async def _insert_users(
+        self, user_ids: list[int], created_at: datetime, steps: list[int], due_times: list[datetime]
+    ) -> int:
+        """
+        Добавляет пачку новых пользователей с одинаковым расписанием.
+
+        Пользователи, которые уже есть в users или в архиве, пропускаются.
+
+        :return: Количество добавленных пользователей
+        """
+
+    @abstractmethod
+    async def _write_updates(
+        self,
+        sent_steps: dict[tuple[int, int], datetime],
+        last_sent: dict[int, datetime],
+        statuses: dict[int, tuple[str, datetime]],
+    ):
+        """
+        Записывает пачку отложенных обновлений одной транзакцией.
+        """
+
+    @abstractmethod
+    async def get_user_msg_times(self, user_id: int) -> dict[int, datetime]:
+        """
+        Возвращает время отправки сообщений воронки для пользователя.
+
+        :param user_id: ID пользователя
+        :return: Словарь {номер сообщения: время отправки}
+        """
+
+    @abstractmethod
+    def get_new_users(self, page_size: int) -> AsyncIterator[UserRow]:
+        """
+        Постранично перебирает новых пользователей, которые еще не получили первое сообщение.
+
+        :param page_size: Количество строк на одной странице
+        """
+
+    @abstractmethod
+    def get_users_for_message(
+        self, interval: timedelta, page_size: int
+    ) -> AsyncIterator[UserRow]:
+        """
+        Постранично перебирает пользователей, которым необходимо отправить следующее сообщение.
+
+        :param interval: Интервал времени с момента последнего отправленного сообщения
+        :param page_size: Количество строк на одной странице
+        """
+
+    @abstractmethod
+    def get_users_to_send_messages(
+        self, page_size: int
+    ) -> AsyncIterator[StepRow]:
+        """
+        Постранично перебирает сообщения воронки, время отправки которых уже наступило.
+
+        :param page_size: Количество строк на одной странице
+        :return: Асинхронный генератор StepRow
+        """
+
+    @abstractmethod
+    async def _claim_due_steps(
+        self, owner: str, limit: int, lease_seconds: float
+    ) -> list[StepRow]:
+        """
+        Арендует наступившие сообщения воронки для отправки этим воркером.
+
+        :param owner: Идентификатор воркера
+        :param limit: Максимальное количество шагов
+        :param lease_seconds: Срок аренды в секундах
+        :return: Список StepRow
+        """
+
+    @abstractmethod
+    async def _mark_sent(self, user_id: int, step: int, owner: str, sent_at: datetime) -> bool:
+        """
+        Отмечает арендованный шаг отправленным, снимает аренду и тем же
+        запросом обновляет время последнего сообщения пользователя.
+
+        :return: False, если шаг не арендован этим воркером или уже отправлен
+        """
+
+    @abstractmethod
+    async def release_step(self, user_id: int, step: int, owner: str, retry_at: datetime):
+        """
+        Возвращает арендованный шаг, запрещая повторную аренду до retry_at.
+
+        :param user_id: ID пользователя
+        :param step: Номер сообщения
+        :param owner: Идентификатор воркера
+        :param retry_at: Время, после которого шаг можно арендовать снова
+        """
+
+    @abstractmethod
+    async def archive_users(self, before: datetime, limit: int) -> int:
+        """
+        Переносит пачку завершенных воронок в архив.
+
+        Воронка завершена, если пользователь finished или получил все сообщения.
+
+        :param before: Воронки, завершенные раньше этого времени, переносятся в архив
+        :param limit: Максимальное количество пользователей в пачке
+        :return: Количество перенесенных пользователей
+        """
+
+    @abstractmethod
+    async def purge_archive(self, before: datetime):
+        """
+        Удаляет из архива воронки, перенесенные раньше before.
+
+        :param before: Граница срока хранения архива
+        """
+
+    @abstractmethod
+    def iter_pending_messages(self, until: datetime, page_size: int) -> AsyncIterator[StepRow]:
+        """
+        Постранично перебирает следующие неотправленные сообщения активных
+        пользователей со временем отправки не позже until.
+
+        :param until: Граница времени отправки
+        :param page_size: Количество строк на одной странице
+        :return: Асинхронный генератор StepRow
+        """
+
+    async def close(self):
+        """
+        Сбрасывает отложенные обновления и закрывает хранилище.
+        """
+        if self._flush_task:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
+        await self._close()
+
+    def _start_flusher(self):
+        self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def get_user(self, user_id: int) -> Optional[User]:
+        """
+        Возвращает пользователя по его ID.
+
+        :param user_id: ID пользователя
+        :return: Объект User или None, если пользователь не найден
+        """
+        user = self.users.get(user_id)
+        if user is not None:
+            return user
+
+        user = await self._fetch_user(user_id)
+        if user is not None:
+            self.users.put(user)
+        return user
+
+    async def add_user(self, user: User) -> list[datetime]:
+        """
+        Добавляет нового пользователя и его расписание.
+
+        :param user: Объект User
+        :return: Время отправки каждого сообщения воронки или пустой список,
+            если пользователь уже существует
+        """
+        steps, due_times = self._schedule(datetime.now(timezone.utc))
+        if not await self._insert_user(user, steps, due_times):
+            # Пользователь уже существует, в кэше могут быть неактуальные данные
+            self.users.invalidate(user.id)
+            return []
+        self.users.put(user)
+        return due_times
+
+    async def enroll_users(self, user_ids: Iterable[int], batch_size: int) -> int:
+        """
+        Массово добавляет пользователей в воронку.
+
+        Расписание считается так же, как в add_user, от момента записи пачки.
+        Уже добавленные и архивные пользователи пропускаются.
+
+        :param user_ids: ID пользователей, можно передать ленивый итератор
+        :param batch_size: Количество пользователей в одной транзакции
+        :return: Количество добавленных пользователей
+        """
+        user_ids = iter(user_ids)
+        enrolled = 0
+        while batch := list(dict.fromkeys(islice(user_ids, batch_size))):
+            created_at = datetime.now(timezone.utc)
+            steps, due_times = self._schedule(created_at)
+            enrolled += await self._insert_users(batch, created_at, steps, due_times)
+        return enrolled
+
+    @staticmethod
+    def _schedule(start: datetime) -> tuple[list[int], list[datetime]]:
+        # Вычисление времени отправки для каждого сообщения воронки
+        steps = []
+        due_times = []
+        due_at = start
+        for step, _, interval in settings.funnel_steps():
+            due_at += timedelta(seconds=interval)
+            steps.append(step)
+            due_times.append(due_at)
+        return steps, due_times
+
+    async def claim_due_steps(
+        self, owner: str, limit: int, lease_seconds: float
+    ) -> list[StepRow]:
+        """
+        Арендует наступившие сообщения воронки для отправки этим воркером.
+
+        Отметки об отправке, оставшиеся в буфере после ошибки записи, сначала
+        записываются в хранилище. Шаги, которые по данным буфера уже отправлены
+        или принадлежат завершенным пользователям, не возвращаются.
+
+        :param owner: Идентификатор воркера
+        :param limit: Максимальное количество шагов
+        :param lease_seconds: Срок аренды в секундах
+        :return: Список StepRow
+        """
+        if self._sent_steps:
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Не удалось записать отложенные обновления перед арендой")
+
+        claimed = await self._claim_due_steps(owner, limit, lease_seconds)
+        return [
+            row
+            for row in claimed
+            if (row.user_id, row.step) not in self._sent_steps
+            and self._statuses.get(row.user_id, ("alive",))[0] == "alive"
+        ]
+
+    async def mark_step_sent(self, user_id: int, step: int, owner: str, sent_at: datetime):
+        """
+        Сразу отмечает арендованный шаг отправленным и обновляет время
+        последнего сообщения пользователя.
+
+        Отметка пишется синхронно, а не через отложенную запись: пока она не
+        в хранилище, шаг защищен только арендой, и после ее истечения сообщение
+        было бы отправлено повторно. Поэтому доставленное сообщение стоит один
+        запрос к хранилищу, в который входит и время последнего сообщения.
+        При ошибке записи отметка остается в буфере, а claim_due_steps не вернет
+        этот шаг, пока буфер не записан.
+
+        :param user_id: ID пользователя
+        :param step: Номер сообщения
+        :param owner: Идентификатор воркера, арендовавшего шаг
+        :param sent_at: Время отправки сообщения
+        """
+        try:
+            marked = await self._mark_sent(user_id, step, owner, sent_at)
+        except Exception:
+            logger.exception("Не удалось отметить сообщение %s пользователя %s", step, user_id)
+            await self.update_message_status(user_id, step, sent_at)
+            await self.update_last_message_sent_at(user_id, sent_at)
+            return
+        if not marked:
+            logger.warning(
+                "Сообщение %s пользователя %s отправлено без действующей аренды", step, user_id
+            )
+            # Сообщение доставлено, хотя шаг отметил не этот воркер
+            await self.update_last_message_sent_at(user_id, sent_at)
+            return
+        self._cache_last_message_sent_at(user_id, sent_at)
+
+    async def update_user_status(self, user_id: int, status: str, updated_at: datetime):
+        """
+        Обновляет статус пользователя (отложенная запись).
+
+        :param user_id: ID пользователя
+        :param status: Новый статус пользователя
+        :param updated_at: Время обновления статуса
+        """
+        current = self._statuses.get(user_id)
+        if current is None or current[1] <= updated_at:
+            self._statuses[user_id] = (status, updated_at)
+        user = self.users.peek(user_id)
+        if user is not None and user.status_updated_at <= updated_at:
+            user.status = status
+            user.status_updated_at = updated_at
+        self._buffer_updated()
+
+    async def update_last_message_sent_at(self, user_id: int, sent_at: datetime):
+        """
+        Обновляет время отправки последнего сообщения пользователя (отложенная запись).
+
+        :param user_id: ID пользователя
+        :param sent_at: Время отправки сообщения
+        """
+        current = self._last_sent.get(user_id)
+        if current is None or current < sent_at:
+            self._last_sent[user_id] = sent_at
+        self._cache_last_message_sent_at(user_id, sent_at)
+        self._buffer_updated()
+
+    def _cache_last_message_sent_at(self, user_id: int, sent_at: datetime):
+        user = self.users.peek(user_id)
+        if user is not None and (
+            user.last_message_sent_at is None or user.last_message_sent_at < sent_at
+        ):
+            user.last_message_sent_at = sent_at
+
+    async def update_message_status(self, user_id: int, step: int, sent_at: datetime):
+        """
+        Отмечает сообщение воронки отправленным (отложенная запись).
+
+        :param user_id: ID пользователя
+        :param step: Номер сообщения
+        :param sent_at: Время отправки сообщения
+        """
+        self._sent_steps[(user_id, step)] = sent_at
+        self._buffer_updated()
+
+    def has_buffered_status(self, user_id: int) -> bool:
+        """
+        Проверяет, ждет ли статус пользователя записи в хранилище.
+
+        :param user_id: ID пользователя
+        """
+        return user_id in self._statuses
+
+    def _buffer_updated(self):
+        buffered = len(self._sent_steps) + len(self._last_sent) + len(self._statuses)
+        if buffered >= settings.db_flush_max_items:
+            self._flush_needed.set()
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(
+                    self._flush_needed.wait(), timeout=settings.db_flush_interval / 1000
+                )
+            except asyncio.TimeoutError:
+                pass
+            self._flush_needed.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Не удалось записать отложенные обновления")
+
+    async def flush(self):
+        """
+        Записывает накопленные обновления одной транзакцией.
+
+        При ошибке обновления возвращаются в буфер и будут записаны при следующем сбросе.
+        """
+        async with self._flush_lock:
+            sent_steps, self._sent_steps = self._sent_steps, {}
+            last_sent, self._last_sent = self._last_sent, {}
+            statuses, self._statuses = self._statuses, {}
+            if not (sent_steps or last_sent or statuses):
+                return
+
+            try:
+                await self._write_updates(sent_steps, last_sent, statuses)
+            except BaseException:
+                # Более новые обновления, пришедшие во время записи, остаются приоритетными
+                for key, value in sent_steps.items():
+                    self._sent_steps.setdefault(key, value)
+                for user_id, sent_at in last_sent.items():
+                    current = self._last_sent.get(user_id)
+                    if current is None or current < sent_at:
+                        self._last_sent[user_id] = sent_at
+                for user_id, value in statuses.items():
+                    self._statuses.setdefault(user_id, value)
+                raise
+
+
+def create_storage() -> Storage:
+    """
+    Создает хранилище, выбранное в settings.storage_backend.
+    """
+    if settings.storage_backend == "sqlite":
+        from core.db.sqlite import SQLiteDatabase
+
+        return SQLiteDatabase(settings.sqlite_path)
+    if settings.storage_backend == "postgres":
+        from core.db.db import Database
+
+        return Database()
+    raise ValueError(f"Неизвестное хранилище: {settings.storage_backend}")
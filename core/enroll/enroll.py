@@ -0,0 +1,89 @@
+# core/enroll/enroll.py
+
+"""
+Массовое добавление контактов в воронку из CSV.
+
+Запуск из корня репозитория:
+    python -m core.enroll.enroll contacts.csv --column user_id
+"""
+
+import argparse
+import asyncio
+import csv
+import logging
+import time
+from typing import Iterator
+
+from core.db.storage import create_storage
+from core.settings.settings import settings
+
+logger = logging.getLogger(__name__)
+
+
+def read_user_ids(path: str, column: str = "0") -> Iterator[int]:
+    """
+    Лениво читает ID пользователей из CSV.
+
+    Строки, в которых нет числового ID (заголовок, пустые строки), пропускаются.
+
+    :param path: Путь к CSV-файлу
+    :param column: Номер столбца или его имя в заголовке
+    :return: Итератор ID пользователей
+    :raises ValueError: Если в заголовке нет столбца с именем column
+    """
+    with open(path, newline="", encoding="utf-8") as file:
+        rows = csv.reader(file)
+        index = int(column) if column.isdigit() else None
+        for row in rows:
+            if index is None:
+                # Первая строка - заголовок с именами столбцов
+                if column not in row:
+                    raise ValueError(
+                        f"В заголовке {path} нет столбца {column!r}, "
+                        f"есть: {', '.join(row) or 'пустой заголовок'}"
+                    )
+                index = row.index(column)
+                continue
+            try:
+                yield int(row[index])
+            except (IndexError, ValueError):
+                logger.warning("Пропущена строка %s: %s", rows.line_num, row)
+
+
+async def enroll(path: str, column: str, batch_size: int) -> int:
+    """
+    Добавляет в воронку всех пользователей из CSV.
+
+    :param path: Путь к CSV-файлу
+    :param column: Номер столбца или его имя в заголовке
+    :param batch_size: Количество пользователей в одной транзакции
+    :return: Количество добавленных пользователей
+    """
+    db = create_storage()
+    await db.connect()
+    try:
+        return await db.enroll_users(read_user_ids(path, column), batch_size)
+    finally:
+        await db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("path", help="CSV-файл с ID пользователей")
+    parser.add_argument("--column", default="0", help="номер столбца или имя в заголовке")
+    parser.add_argument("--batch-size", type=int, default=settings.enroll_batch_size)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    started_at = time.perf_counter()
+    try:
+        enrolled = asyncio.run(enroll(args.path, args.column, args.batch_size))
+    except ValueError as e:
+        parser.error(str(e))
+    logger.info(
+        "Добавлено пользователей: %s за %.1f с", enrolled, time.perf_counter() - started_at
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+# core/funnel/coalescer.py
+
+import asyncio
+import logging
+from typing import Awaitable, Callable
+
+from pyrogram.types import Message
+
+from core.metrics.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class InboundCoalescer:
+    """
+    Объединяет входящие сообщения пользователя, пришедшие подряд.
+
+    Первое сообщение открывает окно, все сообщения пользователя за это окно
+    передаются обработчику одной пачкой. Окно не продлевается новыми
+    сообщениями, поэтому задержка обработки не превышает window.
+
+    Одновременно обрабатывается не больше workers пачек, чтобы обработчики
+    не забирали весь пул соединений у отправки. Пачка, не дождавшаяся
+    соединения, возвращается в окно и обрабатывается повторно.
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[int, list[Message]], Awaitable[None]],
+        window: float,
+        max_messages: int,
+        workers: int,
+    ):
+        self.handler = handler
+        self.window = window
+        self.max_messages = max_messages
+        self._workers = asyncio.Semaphore(workers)
+        self._pending: dict[int, list[Message]] = {}  # user_id -> сообщения в окне
+        self._timers: dict[int, asyncio.Task] = {}
+
+    async def add(self, user_id: int, message: Message):
+        """
+        Добавляет сообщение в окно пользователя.
+
+        :param user_id: ID пользователя
+        :param message: Входящее сообщение
+        """
+        batch = self._pending.get(user_id)
+        if batch is None:
+            self._pending[user_id] = [message]
+            self._timers[user_id] = asyncio.create_task(self._flush_later(user_id))
+            return
+
+        batch.append(message)
+        metrics.inbound_coalesced.inc()
+        if len(batch) >= self.max_messages:
+            self._timers.pop(user_id).cancel()
+            await self._process(user_id)
+
+    async def flush(self):
+        """
+        Немедленно обрабатывает все открытые окна.
+        """
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers.clear()
+        await asyncio.gather(*(self._process(user_id) for user_id in list(self._pending)))
+
+    async def _flush_later(self, user_id: int):
+        await asyncio.sleep(self.window)
+        del self._timers[user_id]
+        await self._process(user_id)
+
+    async def _process(self, user_id: int):
+        messages = self._pending.pop(user_id, None)
+        if not messages:
+            return
+        async with self._workers:
+            try:
+                await self.handler(user_id, messages)
+            except asyncio.TimeoutError:
+                # Пул соединений занят: пачка не теряется, а ждет следующего окна
+                logger.warning(
+                    "Нет соединения для сообщений пользователя %s, повтор через %.1f с",
+                    user_id,
+                    self.window,
+                )
+                self._requeue(user_id, messages)
+            except Exception:
+                # Ошибка одной пачки не должна останавливать обработку остальных
+                logger.exception("Не удалось обработать сообщения пользователя %s", user_id)
+
+    def _requeue(self, user_id: int, messages: list[Message]):
+        self._pending[user_id] = messages + self._pending.get(user_id, [])
+        if user_id not in self._timers:
+            self._timers[user_id] = asyncio.create_task(self._flush_later(user_id))
@@ -1,90 +1,137 @@
 from datetime import datetime, timedelta, timezone
-from pyrogram import Client
 from pyrogram.types import Message
-from core.db.db import Database
+from core.client.client import SendRejected, TelegramClient
+from core.client.governor import SendThrottled
+from core.db.storage import Storage
 from core.db.models import User
+from core.funnel.coalescer import InboundCoalescer
+from core.funnel.triggers import TriggerMatcher
+from core.metrics.metrics import metrics
+from core.scheduler.scheduler import FunnelScheduler
 from core.settings.settings import settings
-import asyncio
 
 
 class MessageFunnel:
     def __init__(self, db, client):
-        self.db: Database = db
-        self.client: Client = client
-        self.db_semaphore = asyncio.Semaphore(
-            1
-        )  # Семафор для управления доступом к базе данных
+        self.db: Storage = db
+        self.client: TelegramClient = client
+        self.scheduler = FunnelScheduler(db, self.send_step, client.governor)
+        self.messages = {step: text for step, text, _ in settings.funnel_steps()}
+        self.triggers = TriggerMatcher(settings.trigger_phrases)
+        self.inbound = InboundCoalescer(
+            self.process_user_messages,
+            settings.inbound_window / 1000,
+            settings.inbound_batch_max,
+            settings.inbound_workers,
+        )
 
     async def process_message(self, message: Message):
         """
-        Обрабатывает входящие сообщения и обновляет статус пользователя в базе данных.
+        Обрабатывает сообщения чата и обновляет статус пользователя в базе данных.
 
-        :param message: Входящее сообщение
+        :param message: Входящее или исходящее сообщение
         """
-        user_id = message.from_user.id
-
         # Проверка на пустое сообщение
         if not message.text:
             return
 
-        async with self.db_semaphore:
-            user = await self.db.get_user(user_id)
-
-            if not user:
-                # Новый пользователь
-                user = User(
-                    id=user_id,
-                    created_at=datetime.now(timezone.utc),
-                    status="alive",
-                    status_updated_at=datetime.now(timezone.utc),
-                    last_message_sent_at=None,  # Новые пользователи не имеют отправленных сообщений
-                )
-                await self.db.add_user(user)
-
-        # Мониторинг триггеров
-        async for msg in self.client.get_chat_history(user_id):
-            if msg.text and (
-                "прекрасно" in msg.text.lower() or "ожидать" in msg.text.lower()
-            ):
-                async with self.db_semaphore:
-                    await self.db.update_user_status(
-                        user_id, "finished", datetime.now(timezone.utc)
-                    )
-                return
-
-    async def send_scheduled_messages(self):
+        # Исходящие сообщения только проверяются на триггеры
+        if message.outgoing:
+            if self.triggers.match(message.text):
+                metrics.trigger_hits.inc(label="outgoing")
+                await self.finish_user(message.chat.id)
+            return
+
+        user_id = message.from_user.id
+        if settings.inbound_window:
+            # Серия сообщений пользователя обрабатывается одной пачкой
+            await self.inbound.add(user_id, message)
+        else:
+            await self.process_user_messages(user_id, [message])
+
+    async def process_user_messages(self, user_id: int, messages: list[Message]):
+        """
+        Обрабатывает пачку входящих сообщений одного пользователя.
+
+        :param user_id: ID пользователя
+        :param messages: Входящие сообщения пользователя
+        """
+        user = await self.db.get_user(user_id)
+
+        if not user:
+            # Новый пользователь
+            user = User(
+                id=user_id,
+                created_at=datetime.now(timezone.utc),
+                status="alive",
+                status_updated_at=datetime.now(timezone.utc),
+                last_message_sent_at=None,  # Новые пользователи не имеют отправленных сообщений
+            )
+            due_times = await self.db.add_user(user)
+            for step, due_at in enumerate(due_times, start=1):
+                self.scheduler.schedule(user_id, step, due_at)
+
+        # Мониторинг триггеров: достаточно одного совпадения среди всех сообщений пачки
+        if any(self.triggers.match(message.text) for message in messages):
+            metrics.trigger_hits.inc(label="incoming")
+            await self.finish_user(user_id)
+
+    async def finish_user(self, user_id: int):
         """
-        Отправляет запланированные сообщения пользователям.
+        Завершает воронку для пользователя.
+
+        :param user_id: ID пользователя
+        """
+        self.scheduler.cancel(user_id)
+        await self.db.update_user_status(user_id, "finished", datetime.now(timezone.utc))
+
+    async def send_step(self, user_id: int, step: int):
+        """
+        Отправляет пользователю сообщение воронки и отмечает его отправленным.
+
+        :param user_id: ID пользователя
+        :param step: Номер сообщения
+        :raises SendRejected: Если сообщение отправить невозможно
+        """
+        text = self.messages.get(step)
+        if text is None:
+            # Шаг убран из настроек воронки после записи пользователя
+            raise SendRejected(user_id, f"нет сообщения воронки {step}")
+        await self.client.send_message(user_id, text)
+        await self.db.mark_step_sent(
+            user_id, step, self.scheduler.owner, datetime.now(timezone.utc)
+        )
+
+        # Сообщения, отправленные через API, не приходят в обработчики
+        if self.triggers.match(text):
+            metrics.trigger_hits.inc(label="funnel")
+            await self.finish_user(user_id)
+
+    async def send_scheduled_messages(self) -> int:
+        """
+        Отправляет запланированные сообщения, время которых уже наступило.
+
+        Сообщения предварительно арендуются, поэтому метод можно вызывать
+        одновременно из нескольких процессов.
+
+        :return: Количество отправленных сообщений
         """
-        current_time = datetime.now(timezone.utc)
-        async with self.db_semaphore:
-            users_to_message = await self.db.get_users_to_send_messages()
-        for user in users_to_message:
-            user_id = user["user_id"]
-            if (
-                user["msg_1"]
-                and user["msg_1"] <= current_time
-                and not user["status_msg_1"]
-            ):
-                await self.client.send_message(user_id, settings.msg_1)
-                async with self.db_semaphore:
-                    await self.db.update_message_status(user_id, 1)
-                    await self.db.update_last_message_sent_at(user_id, current_time)
-            elif (
-                user["msg_2"]
-                and user["msg_2"] <= current_time
-                and not user["status_msg_2"]
-            ):
-                await self.client.send_message(user_id, settings.msg_2)
-                async with self.db_semaphore:
-                    await self.db.update_message_status(user_id, 2)
-                    await self.db.update_last_message_sent_at(user_id, current_time)
-            elif (
-                user["msg_3"]
-                and user["msg_3"] <= current_time
-                and not user["status_msg_3"]
-            ):
-                await self.client.send_message(user_id, settings.msg_3)
-                async with self.db_semaphore:
-                    await self.db.update_message_status(user_id, 3)
-                    await self.db.update_last_message_sent_at(user_id, current_time)
+        if self.client.governor.global_pause():
+            return 0
+
+        messages_to_send = await self.db.claim_due_steps(
+            self.scheduler.owner, settings.lease_batch_size, settings.lease_ttl
+        )
+        sent = 0
+        for user_id, step, _ in messages_to_send:
+            try:
+                await self.send_step(user_id, step)
+            except SendThrottled as e:
+                retry_at = datetime.now(timezone.utc) + timedelta(seconds=e.retry_after)
+                await self.db.release_step(user_id, step, self.scheduler.owner, retry_at)
+                continue
+            except SendRejected:
+                await self.finish_user(user_id)
+                continue
+            sent += 1
+        return sent
@@ -0,0 +1,26 @@
+# core/funnel/triggers.py
+
+import re
+from typing import Iterable, Optional
+
+
+class TriggerMatcher:
+    def __init__(self, phrases: Iterable[str]):
+        # Длинные фразы идут первыми, чтобы альтернатива не обрывалась на префиксе
+        alternatives = sorted({phrase for phrase in phrases if phrase}, key=len, reverse=True)
+        self.pattern: Optional[re.Pattern] = (
+            re.compile("|".join(map(re.escape, alternatives)), re.IGNORECASE)
+            if alternatives
+            else None
+        )
+
+    def match(self, text: Optional[str]) -> bool:
+        """
+        Проверяет, содержит ли текст хотя бы одну триггерную фразу.
+
+        :param text: Текст сообщения
+        :return: True, если найдена триггерная фраза
+        """
+        if not text or self.pattern is None:
+            return False
+        return self.pattern.search(text) is not None
@@ -0,0 +1,208 @@
+# core/metrics/metrics.py
+
+import contextlib
+import functools
+import logging
+import time
+from bisect import bisect_left
+from typing import Callable, Optional
+
+from core.settings.settings import settings
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм в секундах
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _labels(label_name: Optional[str], label: Optional[str], extra: str = "") -> str:
+    parts = []
+    if label_name and label is not None:
+        parts.append(f'{label_name}="{label}"')
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Counter:
+    def __init__(self, name: str, help: str, label_name: Optional[str] = None):
+        self.name = name
+        self.help = help
+        self.label_name = label_name
+        self.values: dict[Optional[str], float] = {}
+
+    def inc(self, amount: float = 1, label: Optional[str] = None):
+        self.values[label] = self.values.get(label, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for label, value in self.values.items():
+            lines.append(f"{self.name}{_labels(self.label_name, label)} {value}")
+        return lines
+
+
+class Gauge:
+    def __init__(self, name: str, help: str, function: Optional[Callable[[], float]] = None):
+        self.name = name
+        self.help = help
+        self.function = function
+        self.value = 0.0
+
+    def set(self, value: float):
+        self.value = value
+
+    def get(self) -> float:
+        return self.function() if self.function else self.value
+
+    def render(self) -> list[str]:
+        return [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} gauge",
+            f"{self.name} {self.get()}",
+        ]
+
+
+class _HistogramValues:
+    def __init__(self, size: int):
+        self.buckets = [0] * size
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+
+class Histogram:
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        label_name: Optional[str] = None,
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        self.name = name
+        self.help = help
+        self.label_name = label_name
+        self.bounds = buckets
+        self.values: dict[Optional[str], _HistogramValues] = {}
+
+    def observe(self, value: float, label: Optional[str] = None):
+        values = self.values.get(label)
+        if values is None:
+            values = self.values[label] = _HistogramValues(len(self.bounds))
+        index = bisect_left(self.bounds, value)
+        if index < len(self.bounds):
+            values.buckets[index] += 1
+        values.count += 1
+        values.sum += value
+        values.max = max(values.max, value)
+
+    def summary(self, label: Optional[str] = None) -> dict:
+        """
+        Возвращает количество, среднее и максимум наблюдений.
+
+        :param label: Значение метки
+        """
+        values = self.values.get(label)
+        if values is None:
+            return {"count": 0, "avg": 0.0, "max": 0.0}
+        return {"count": values.count, "avg": values.sum / values.count, "max": values.max}
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for label, values in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.bounds, values.buckets):
+                cumulative += count
+                le = _labels(self.label_name, label, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            le = _labels(self.label_name, label, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{le} {values.count}")
+            lines.append(f"{self.name}_sum{_labels(self.label_name, label)} {values.sum}")
+            lines.append(f"{self.name}_count{_labels(self.label_name, label)} {values.count}")
+        return lines
+
+
+class Metrics:
+    def __init__(self):
+        self.db_query_seconds = Histogram(
+            "funnel_db_query_seconds", "Время выполнения запросов к хранилищу", "query"
+        )
+        self.send_seconds = Histogram(
+            "funnel_telegram_send_seconds", "Время вызова send_message"
+        )
+        self.history_seconds = Histogram(
+            "funnel_telegram_history_seconds", "Время вызова get_chat_history"
+        )
+        self.scheduler_tick_seconds = Histogram(
+            "funnel_scheduler_tick_seconds", "Время одного прохода планировщика"
+        )
+        self.scheduler_lag_seconds = Histogram(
+            "funnel_scheduler_lag_seconds", "Опоздание отправки относительно due_at"
+        )
+        self.send_queue_wait_seconds = Histogram(
+            "funnel_send_queue_wait_seconds", "Ожидание свободного отправителя в очереди"
+        )
+        self.send_stage_seconds = Histogram(
+            "funnel_send_stage_seconds", "Отправка сообщения воронки и отметка в хранилище"
+        )
+        self.sends = Counter("funnel_sends_total", "Отправленные сообщения воронки")
+        self.flood_waits = Counter(
+            "funnel_flood_waits_total", "Ответы FloodWait/SlowmodeWait от Telegram", "kind"
+        )
+        self.send_rejections = Counter(
+            "funnel_send_rejections_total", "Отправки, окончательно отклоненные Telegram", "error"
+        )
+        self.trigger_hits = Counter(
+            "funnel_trigger_hits_total", "Сработавшие триггерные фразы", "direction"
+        )
+        self.inbound_coalesced = Counter(
+            "funnel_inbound_coalesced_total", "Входящие сообщения, объединенные с предыдущими"
+        )
+        self.archived_users = Counter(
+            "funnel_archived_users_total", "Пользователи, перенесенные в архив"
+        )
+        self.due_backlog = Gauge(
+            "funnel_due_backlog", "Наступившие сообщения в очереди и в отправке"
+        )
+        self.scheduled = Gauge("funnel_scheduled_steps", "Сообщения в локальной очереди")
+
+    def render(self) -> str:
+        """
+        Возвращает все метрики в текстовом формате Prometheus.
+        """
+        lines = []
+        for metric in vars(self).values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+@contextlib.contextmanager
+def time_query(name: str):
+    """
+    Замеряет время запроса к хранилищу и пишет медленные запросы в лог.
+
+    :param name: Метка запроса
+    """
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started_at
+        metrics.db_query_seconds.observe(elapsed, name)
+        if settings.slow_query_ms and elapsed * 1000 >= settings.slow_query_ms:
+            logger.warning("Медленный запрос %s: %.1f мс", name, elapsed * 1000)
+
+
+def timed_query(function):
+    """
+    Декоратор для time_query, меткой служит имя метода.
+    """
+
+    @functools.wraps(function)
+    async def wrapper(*args, **kwargs):
+        with time_query(function.__name__):
+            return await function(*args, **kwargs)
+
+    return wrapper
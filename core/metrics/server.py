@@ -0,0 +1,79 @@
+# core/metrics/server.py
+
+import asyncio
+import json
+from typing import Awaitable, Callable, Optional
+
+from core.metrics.metrics import metrics
+
+
+class MetricsServer:
+    """
+    Минимальный HTTP-сервер для локального сбора метрик.
+
+    GET /metrics отдает метрики в формате Prometheus, GET /stats отдает
+    дополнительную статистику в JSON, GET /health отвечает 200 или 503
+    в зависимости от доступности хранилища.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        stats: Callable[[], dict] = dict,
+        health: Optional[Callable[[], Awaitable[bool]]] = None,
+    ):
+        self.host = host
+        self.port = port
+        self.stats = stats
+        self.health = health
+        self.server: asyncio.AbstractServer = None
+
+    async def start(self):
+        """
+        Начинает принимать соединения.
+        """
+        self.server = await asyncio.start_server(self._handle, self.host, self.port)
+
+    async def stop(self):
+        """
+        Останавливает сервер.
+        """
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await reader.readline()
+            # Заголовки запроса не нужны, но их нужно вычитать
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+
+            parts = request_line.decode("latin-1").split()
+            path = parts[1] if len(parts) > 1 else ""
+            if path == "/metrics":
+                status, content_type = "200 OK", "text/plain; version=0.0.4"
+                body = metrics.render().encode()
+            elif path == "/stats":
+                status, content_type = "200 OK", "application/json"
+                body = json.dumps(self.stats(), default=str).encode()
+            elif path == "/health" and self.health:
+                content_type = "text/plain"
+                if await self.health():
+                    status, body = "200 OK", b"ok\n"
+                else:
+                    status, body = "503 Service Unavailable", b"storage unavailable\n"
+            else:
+                status, content_type, body = "404 Not Found", "text/plain", b"not found\n"
+
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                f"Content-Type: {content_type}; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Connection: close\r\n\r\n".encode()
+                + body
+            )
+            await writer.drain()
+        finally:
+            writer.close()
@@ -0,0 +1,236 @@
+# core/scheduler/scheduler.py
+
+import asyncio
+import heapq
+import logging
+import os
+import socket
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, Optional
+
+from core.client.client import SendRejected
+from core.client.governor import SendGovernor, SendThrottled
+from core.db.storage import Storage
+from core.metrics.metrics import metrics
+from core.settings.settings import settings
+
+logger = logging.getLogger(__name__)
+
+
+class FunnelScheduler:
+    def __init__(
+        self,
+        db,
+        send_step: Callable[[int, int], Awaitable[None]],
+        governor: Optional[SendGovernor] = None,
+    ):
+        self.db: Storage = db
+        self.send_step = send_step
+        self.governor = governor
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"  # владелец аренды шагов
+        # Локальные подсказки о времени отправки; сами шаги арендуются в базе данных
+        self._queue: list[tuple[datetime, int, int]] = []  # (due_at, user_id, step)
+        self._pending: set[tuple[int, int]] = set()  # (user_id, step) в локальной очереди
+        # user_id -> время отмены; запись нужна, пока в базе пользователь еще alive
+        # или пока в очереди могут оставаться его арендованные шаги
+        self._cancelled: OrderedDict[int, float] = OrderedDict()
+        self._wakeup = asyncio.Event()
+        self._space = asyncio.Event()  # в очереди отправки освободилось место
+        # Очередь между планировщиком и отправителями:
+        # (user_id, step, due_at, enqueued_at, lease_deadline)
+        self._sends: asyncio.Queue = asyncio.Queue(maxsize=settings.send_queue_size)
+        self._in_flight = 0
+        self._loaded_at = float("-inf")  # время последней подгрузки шагов из базы
+        metrics.due_backlog.function = lambda: self._sends.qsize() + self._in_flight
+        metrics.scheduled.function = lambda: len(self._queue)
+
+    def schedule(self, user_id: int, step: int, due_at: datetime):
+        """
+        Добавляет сообщение воронки в очередь и будит цикл планировщика.
+
+        :param user_id: ID пользователя
+        :param step: Номер сообщения
+        :param due_at: Время отправки
+        """
+        if (user_id, step) in self._pending:
+            return
+        self._pending.add((user_id, step))
+        heapq.heappush(self._queue, (due_at, user_id, step))
+        if self._queue[0] == (due_at, user_id, step):
+            self._wakeup.set()
+
+    def cancel(self, user_id: int):
+        """
+        Отменяет все еще не отправленные сообщения пользователя.
+
+        :param user_id: ID пользователя
+        """
+        self._cancelled[user_id] = time.monotonic()
+        self._cancelled.move_to_end(user_id)
+
+    def _prune_cancelled(self):
+        # Аренды, взятые до отмены, истекают через lease_ttl, а после записи
+        # статуса в базу шаги пользователя больше не арендуются
+        expired_before = time.monotonic() - settings.lease_ttl
+        while self._cancelled:
+            user_id, cancelled_at = next(iter(self._cancelled.items()))
+            if cancelled_at > expired_before or self.db.has_buffered_status(user_id):
+                break
+            del self._cancelled[user_id]
+
+    def stats(self) -> dict:
+        """
+        Возвращает размеры очередей и время прохождения этапов отправки.
+        """
+        return {
+            "scheduled": len(self._queue),
+            "send_queue_depth": self._sends.qsize(),
+            "in_flight": self._in_flight,
+            "stages": {
+                "tick": metrics.scheduler_tick_seconds.summary(),
+                "queue_wait": metrics.send_queue_wait_seconds.summary(),
+                "send": metrics.send_stage_seconds.summary(),
+                "lag": metrics.scheduler_lag_seconds.summary(),
+            },
+        }
+
+    async def load(self):
+        """
+        Подгружает из базы данных ближайшие шаги воронок.
+
+        В памяти держится только горизонт в lease_poll_interval секунд
+        и только следующий неотправленный шаг каждого пользователя,
+        остальное подгружается при следующих опросах.
+        """
+        self._loaded_at = time.monotonic()
+        until = datetime.now(timezone.utc) + timedelta(seconds=settings.lease_poll_interval)
+        async for user_id, step, due_at in self.db.iter_pending_messages(
+            until, settings.scheduler_page_size
+        ):
+            self.schedule(user_id, step, due_at)
+
+    async def run(self):
+        """
+        Запускает планировщик и пул отправителей.
+        """
+        tasks = [asyncio.create_task(self._send_worker()) for _ in range(settings.send_workers)]
+        tasks.append(asyncio.create_task(self._dispatch()))
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _dispatch(self):
+        # Арендует наступившие шаги и передает их отправителям. Локальная очередь
+        # только подсказывает, когда проснуться; шаги других процессов и шаги
+        # упавших воркеров подхватываются опросом раз в lease_poll_interval
+        while True:
+            self._wakeup.clear()
+            self._prune_cancelled()
+            if time.monotonic() - self._loaded_at >= settings.lease_poll_interval:
+                try:
+                    await self.load()
+                except Exception:
+                    logger.exception("Не удалось подгрузить ближайшие сообщения воронки")
+            now = datetime.now(timezone.utc)
+            while self._queue and self._queue[0][0] <= now:
+                _, user_id, step = heapq.heappop(self._queue)
+                self._pending.discard((user_id, step))
+
+            # Во время общей паузы после FloodWait арендованные шаги пришлось бы
+            # сразу возвращать, поэтому аренда ждет окончания паузы
+            pause = self.governor.global_pause() if self.governor else 0.0
+            if pause > 0:
+                await asyncio.sleep(pause)
+                continue
+
+            free = self._sends.maxsize - self._sends.qsize()
+            if free <= 0:
+                self._space.clear()
+                await self._space.wait()
+                continue
+
+            limit = min(settings.lease_batch_size, free)
+            tick_started_at = time.perf_counter()
+            try:
+                claimed = await self.db.claim_due_steps(self.owner, limit, settings.lease_ttl)
+            except Exception:
+                logger.exception("Не удалось арендовать сообщения для отправки")
+                claimed = []
+
+            # Запас на случай расхождения часов процесса и базы данных
+            lease_deadline = time.monotonic() + settings.lease_ttl * 0.9
+            for user_id, step, due_at in claimed:
+                self._sends.put_nowait((user_id, step, due_at, time.monotonic(), lease_deadline))
+            metrics.scheduler_tick_seconds.observe(time.perf_counter() - tick_started_at)
+            if len(claimed) == limit:
+                continue
+
+            timeout = settings.lease_poll_interval
+            if self._queue:
+                head_delay = (self._queue[0][0] - datetime.now(timezone.utc)).total_seconds()
+                timeout = min(timeout, max(head_delay, 0))
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _send_worker(self):
+        while True:
+            user_id, step, due_at, enqueued_at, lease_deadline = await self._sends.get()
+            self._space.set()
+            self._in_flight += 1
+            started_at = time.monotonic()
+            metrics.send_queue_wait_seconds.observe(started_at - enqueued_at)
+            try:
+                # Уже арендованный шаг дожидается конца паузы, если аренда это позволяет
+                pause = self.governor.global_pause() if self.governor else 0.0
+                if 0 < pause and time.monotonic() + pause < lease_deadline:
+                    await asyncio.sleep(pause)
+                # Просроченную аренду мог забрать другой воркер, отправка пропускается
+                if time.monotonic() < lease_deadline:
+                    await self._send(user_id, step, due_at)
+            finally:
+                metrics.send_stage_seconds.observe(time.monotonic() - started_at)
+                self._in_flight -= 1
+                self._sends.task_done()
+
+    async def _send(self, user_id: int, step: int, due_at: datetime):
+        if user_id in self._cancelled:
+            return
+
+        retry_after: Optional[float] = None
+        try:
+            await self.send_step(user_id, step)
+            metrics.scheduler_lag_seconds.observe(
+                (datetime.now(timezone.utc) - due_at).total_seconds()
+            )
+        except SendThrottled as e:
+            # Ограниченный чат переносится, остальные продолжают отправку
+            retry_after = e.retry_after
+        except SendRejected as e:
+            # Повтор не поможет, воронка пользователя завершается
+            logger.warning("Воронка пользователя %s завершена: %s", user_id, e)
+            self.cancel(user_id)
+            try:
+                await self.db.update_user_status(
+                    user_id, "finished", datetime.now(timezone.utc)
+                )
+            except Exception:
+                logger.exception("Не удалось завершить воронку пользователя %s", user_id)
+        except Exception:
+            logger.exception("Не удалось отправить сообщение %s пользователю %s", step, user_id)
+            retry_after = settings.scheduler_retry_delay
+
+        if retry_after is not None:
+            retry_at = datetime.now(timezone.utc) + timedelta(seconds=retry_after)
+            try:
+                await self.db.release_step(user_id, step, self.owner, retry_at)
+            except Exception:
+                # Шаг освободится сам по истечении аренды
+                logger.exception("Не удалось вернуть сообщение %s пользователя %s", step, user_id)
+            self.schedule(user_id, step, retry_at)
@@ -1,6 +1,8 @@
 # core/settings/settings.py
 
 import os
+from typing import Optional
+
 from pydantic import BaseModel
 
 DB_PASS = os.environ.get("DB_PASS")
@@ -9,26 +11,86 @@ DB_IP = "localhost"
 DB_PORT = os.environ.get("DB_PORT")
 BOT_API = os.environ.get("API_ID")
 BOT_HASH = os.environ.get("API_HASH")
+SESSION_NAME = os.environ.get("SESSION_NAME", "my_bot")
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "postgres")
+SQLITE_PATH = os.environ.get("SQLITE_PATH", "funnel.db")
+METRICS_PORT = os.environ.get("METRICS_PORT", "9108")
+DB_STATEMENT_CACHE_SIZE = os.environ.get("DB_STATEMENT_CACHE_SIZE", "100")
+INBOUND_WINDOW = os.environ.get("INBOUND_WINDOW", "0")
+INBOUND_BATCH_MAX = os.environ.get("INBOUND_BATCH_MAX", "20")
+ARCHIVE_INTERVAL = os.environ.get("ARCHIVE_INTERVAL", "3600")
+ARCHIVE_AFTER = os.environ.get("ARCHIVE_AFTER", str(7 * 24 * 3600))
+ARCHIVE_RETENTION = os.environ.get("ARCHIVE_RETENTION", str(365 * 24 * 3600))
+ARCHIVE_BATCH_SIZE = os.environ.get("ARCHIVE_BATCH_SIZE", "1000")
+LEASE_POLL_INTERVAL = os.environ.get("LEASE_POLL_INTERVAL", "5")
+SEND_RATE_RECOVERY_STEP = os.environ.get("SEND_RATE_RECOVERY_STEP", "0.05")
 
 
 class DBSettings(BaseModel):
     """Settings class"""
 
-    db_pass: str
-    db_login: str
+    storage_backend: str = "postgres"  # "postgres" or "sqlite"
+    sqlite_path: str = "funnel.db"
+    db_pass: Optional[str] = None  # Postgres credentials, not needed for sqlite
+    db_login: Optional[str] = None
     db_ip: str
-    db_port: str
+    db_port: Optional[str] = None
     bot_api: str
     bot_hash: str
-    msg_1: str = "Текст 1"
-    msg_2: str = "Текст 2"
-    msg_3: str = "Текст 3"
-    # interval_1: int = 360  # interval in seconds
-    # interval_2: int = 2340
-    # interval_3: int = 93600
-    interval_1: int = 5  # interval in seconds
-    interval_2: int = 10
-    interval_3: int = 15
+    session_name: str = "my_bot"  # separate session per worker process
+    funnel_messages: list[str] = ["Текст 1", "Текст 2", "Текст 3"]
+    # funnel_intervals: list[int] = [360, 2340, 93600]  # intervals in seconds
+    funnel_intervals: list[int] = [5, 10, 15]  # intervals in seconds
+    trigger_phrases: list[str] = ["прекрасно", "ожидать"]
+    inbound_window: int = 0  # milliseconds to coalesce a user's inbound burst, 0 disables
+    inbound_batch_max: int = 20  # messages after which a burst is processed immediately
+    inbound_workers: int = 4  # coalesced batches handled at once, keep below db_pool_max_size
+    db_name: str = "task_test_3"
+    db_pool_min_size: int = 2
+    db_pool_max_size: int = 10
+    db_pool_acquire_timeout: float = 5.0  # seconds
+    db_pool_max_inactive_lifetime: float = 300.0  # seconds
+    db_command_timeout: float = 10.0  # seconds
+    db_statement_cache_size: int = 100  # prepared statements kept per connection
+    db_flush_interval: int = 200  # milliseconds between write-behind flushes
+    db_flush_max_items: int = 500  # buffered updates that trigger an early flush
+    user_cache_size: int = 100_000  # users kept in the in-process cache
+    user_cache_ttl: float = 600.0  # seconds
+    metrics_host: str = "127.0.0.1"
+    metrics_port: int = 9108  # unique per worker on one host, 0 disables the endpoint
+    slow_query_ms: float = 100.0  # log storage queries slower than this, 0 disables
+    scheduler_page_size: int = 1000  # rows per page when loading the queue
+    scheduler_retry_delay: float = 30.0  # seconds before retrying a failed send
+    lease_ttl: float = 120.0  # seconds a claimed step stays reserved for its worker
+    lease_batch_size: int = 100  # steps claimed per query
+    lease_poll_interval: float = 5.0  # seconds between claims when nothing is scheduled locally
+    send_queue_size: int = 1000  # due sends buffered between scheduler and workers
+    send_workers: int = 4  # keep below db_pool_max_size so inbound handlers get connections
+    send_global_rate: float = 25.0  # messages per second for the whole session
+    send_global_burst: float = 30.0
+    send_chat_rate: float = 1.0  # messages per second for a single chat
+    send_chat_burst: float = 3.0
+    send_chat_buckets_max: int = 100_000
+    send_rate_min: float = 1.0
+    send_rate_backoff: float = 0.5  # rate multiplier after FloodWait
+    send_rate_recovery_step: float = 0.05  # share of send_global_rate regained per quiet interval
+    send_rate_recovery_interval: float = 1.0  # seconds
+    archive_interval: float = 3600.0  # seconds between archival runs, 0 disables
+    archive_after: float = 7 * 24 * 3600.0  # seconds a completed funnel stays in the hot tables
+    archive_retention: float = 365 * 24 * 3600.0  # seconds archived funnels are kept, 0 forever
+    archive_batch_size: int = 1000  # users moved per transaction
+    archive_batch_pause: float = 0.1  # seconds between batches to leave the pool to the scheduler
+    enroll_batch_size: int = 10_000  # users inserted per transaction by bulk enrollment
+    migration_batch_size: int = 5000  # legacy rows moved per transaction
+
+    def funnel_steps(self) -> list[tuple[int, str, int]]:
+        """Returns (step, text, interval) for every funnel message"""
+        return [
+            (step, text, interval)
+            for step, (text, interval) in enumerate(
+                zip(self.funnel_messages, self.funnel_intervals, strict=True), start=1
+            )
+        ]
 
 
 settings = DBSettings(
@@ -38,4 +100,17 @@ settings = DBSettings(
     db_port=DB_PORT,
     bot_api=BOT_API,
     bot_hash=BOT_HASH,
+    session_name=SESSION_NAME,
+    storage_backend=STORAGE_BACKEND,
+    sqlite_path=SQLITE_PATH,
+    metrics_port=METRICS_PORT,
+    db_statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+    inbound_window=INBOUND_WINDOW,
+    inbound_batch_max=INBOUND_BATCH_MAX,
+    archive_interval=ARCHIVE_INTERVAL,
+    archive_after=ARCHIVE_AFTER,
+    archive_retention=ARCHIVE_RETENTION,
+    archive_batch_size=ARCHIVE_BATCH_SIZE,
+    lease_poll_interval=LEASE_POLL_INTERVAL,
+    send_rate_recovery_step=SEND_RATE_RECOVERY_STEP,
 )
@@ -1,30 +1,81 @@
 import asyncio
+import logging
+import signal
 
 from pyrogram import filters
 
+from core.archive.archive import Archiver
 from core.client.client import TelegramClient
-from core.db.db import Database
+from core.db.storage import create_storage
 from core.funnel.funnel import MessageFunnel
+from core.metrics.server import MetricsServer
 from core.settings.settings import settings
 
+logger = logging.getLogger(__name__)
+
 
 async def main():
-    db = Database()
+    # SIGTERM (systemd, docker stop) и SIGINT отменяют main, чтобы блок finally
+    # успел записать отложенные обновления перед выходом
+    loop = asyncio.get_running_loop()
+    main_task = asyncio.current_task()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, main_task.cancel)
+
+    db = create_storage()
     await db.connect()
+    if not await db.health_check():
+        await db.close()
+        raise RuntimeError("Хранилище недоступно")
 
-    client = TelegramClient().client
+    telegram = TelegramClient()
+    client = telegram.client
 
-    funnel = MessageFunnel(db, client)
+    funnel = MessageFunnel(db, telegram)
 
     @client.on_message(filters.text)
     async def handle_message(client, message):
         await funnel.process_message(message)
 
-    async with client:
-        while True:
-            await funnel.send_scheduled_messages()
-            await asyncio.sleep(10)  # Задержка между проверками на отправку сообщений
+    metrics_server = MetricsServer(
+        settings.metrics_host,
+        settings.metrics_port,
+        lambda: {"scheduler": funnel.scheduler.stats(), "user_cache": db.users.stats()},
+        db.health_check,
+    )
+
+    try:
+        if settings.metrics_port:
+            try:
+                await metrics_server.start()
+            except OSError:
+                # Занятый порт (например, второй воркер на том же хосте) не мешает рассылке
+                logger.exception(
+                    "Не удалось запустить сервер метрик на порту %s", settings.metrics_port
+                )
+        async with client:
+            # Восстановление очереди отправки из базы данных
+            await funnel.scheduler.load()
+            tasks = [asyncio.create_task(funnel.scheduler.run())]
+            if settings.archive_interval:
+                # Архивация идет отдельной задачей и не задерживает отправку
+                tasks.append(asyncio.create_task(Archiver(db).run()))
+            try:
+                await asyncio.gather(*tasks)
+            finally:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        await metrics_server.stop()
+        # Обработка входящих сообщений, ожидающих в окне объединения
+        await funnel.inbound.flush()
+        # Сброс отложенных обновлений перед выходом
+        await db.close()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    try:
+        asyncio.run(main())
+    except asyncio.CancelledError:
+        pass